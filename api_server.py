@@ -1,17 +1,38 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 import openai
+import httpx
+import aiofiles
+import aiofiles.os
+import asyncio
 import base64
 import io
-from PIL import Image
+import math
+import random
+from PIL import Image, ImageDraw, ImageFilter, ImageOps
+import numpy as np
 import os
 from pathlib import Path
 from dotenv import load_dotenv
 import uuid
 import time
-from typing import Optional, List
+import hashlib
+import hmac
+import re
+import struct
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import quote, urlsplit
+from typing import Optional, List, Dict, NamedTuple, Callable, Tuple
 import json
+import sqlite3
+import threading
 
 # Load environment variables - check multiple locations
 load_dotenv()  # Current directory
@@ -34,14 +55,54 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Upstream connection pool settings
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "32"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+
+# Process-wide async OpenAI client, shared by every request
+openai_client: Optional[openai.AsyncOpenAI] = None
+
+def create_openai_client(api_key: str) -> openai.AsyncOpenAI:
+    """Create an async OpenAI client backed by a pooled keep-alive HTTP client"""
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0)
+    )
+    return openai.AsyncOpenAI(api_key=api_key, http_client=http_client)
+
 # Initialize OpenAI client
-def get_openai_client():
+def get_openai_client() -> openai.AsyncOpenAI:
+    global openai_client
     api_key = os.getenv('OPENAI_API_KEY')
     if not api_key:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-    return openai.OpenAI(api_key=api_key)
+    if openai_client is None:
+        openai_client = create_openai_client(api_key)
+    return openai_client
+
+@app.on_event("startup")
+async def startup_openai_client():
+    """Open the shared upstream connection pool once per worker"""
+    if os.getenv('OPENAI_API_KEY'):
+        get_openai_client()
+        print(f"🔌 OpenAI client ready (max_connections={OPENAI_MAX_CONNECTIONS}, keepalive={OPENAI_MAX_KEEPALIVE})")
 
-# Ensure directories exist
+@app.on_event("shutdown")
+async def shutdown_openai_client():
+    """Close the shared upstream connection pool"""
+    global openai_client
+    if openai_client is not None:
+        await openai_client.close()
+        openai_client = None
+
+# Ensure directories exist (created once per process, not per request)
+@lru_cache(maxsize=None)
 def ensure_directories():
     generated_dir = Path("generated-images")
     generated_dir.mkdir(exist_ok=True)
@@ -97,39 +158,214 @@ STYLE_PROMPTS = {
     }
 }
 
-def convert_image_for_api(image_file):
-    """Convert uploaded image to base64 format for OpenAI API"""
-    try:
-        img = Image.open(image_file)
-        
-        # Convert to RGB if necessary
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-        
-        # Resize if too large
-        width, height = img.size
-        max_dimension = 1024
-        
-        if width > max_dimension or height > max_dimension:
-            if width > height:
-                new_height = int((height * max_dimension) / width)
-                new_width = max_dimension
-            else:
-                new_width = int((width * max_dimension) / height)
-                new_height = max_dimension
-            
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Convert to base64
+class ReferenceImage(NamedTuple):
+    """Encoded reference image passed from preprocessing to the upstream call.
+
+    The encoded bytes travel as-is; a data URL is only built by callers
+    that actually need one.
+    """
+    data: bytes
+    mime_type: str = "image/png"
+    filename: str = "reference.png"
+
+    def as_upload(self) -> tuple:
+        """File tuple accepted by the OpenAI SDK without re-buffering"""
+        return (self.filename, self.data, self.mime_type)
+
+    def to_data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+    def as_png(self) -> "ReferenceImage":
+        """Re-encode as PNG for endpoints that only accept PNG (DALL-E 2 variations)"""
+        if self.mime_type == "image/png":
+            return self
         img_buffer = io.BytesIO()
-        img.save(img_buffer, format='PNG', optimize=True)
-        img_buffer.seek(0)
+        Image.open(io.BytesIO(self.data)).save(img_buffer, format="PNG", compress_level=1)
+        return ReferenceImage(data=img_buffer.getvalue())
+
+# How the reference image is encoded for upload to the image API
+REFERENCE_ENCODING_PROFILES = {
+    "png-optimize": {"format": "PNG", "mime_type": "image/png", "extension": "png",
+                     "options": {"optimize": True}},
+    "png-fast": {"format": "PNG", "mime_type": "image/png", "extension": "png",
+                 "options": {"compress_level": 1}},
+    "png-balanced": {"format": "PNG", "mime_type": "image/png", "extension": "png",
+                     "options": {"compress_level": 6}},
+    "webp-lossless": {"format": "WEBP", "mime_type": "image/webp", "extension": "webp",
+                      "options": {"lossless": True, "quality": 50, "method": 2}},
+    "jpeg-high": {"format": "JPEG", "mime_type": "image/jpeg", "extension": "jpg",
+                  "options": {"quality": 92, "subsampling": 0}}
+}
+
+REFERENCE_ENCODING_PROFILE = os.getenv("REFERENCE_ENCODING_PROFILE", "png-fast")
+
+# Photographic templates upload best as JPEG; flat/cartoon styles keep lossless PNG
+TEMPLATE_ENCODING_PROFILES = {
+    "cover-shoot": "jpeg-high",
+    "footy-fan": "jpeg-high",
+    "retro-remix": "jpeg-high",
+    "funny-toon": "png-fast",
+    "glitch-pro": "png-fast"
+}
+
+def encoding_profile_for(template_id: str) -> str:
+    """Pick the reference encoding profile for a template"""
+    profile = TEMPLATE_ENCODING_PROFILES.get(template_id, REFERENCE_ENCODING_PROFILE)
+    if profile not in REFERENCE_ENCODING_PROFILES:
+        profile = "png-fast"
+    return profile
+
+# Modes each reference encoder is given as-is; anything else is converted first
+ENCODER_MODES = {
+    "JPEG": ("L", "RGB", "CMYK"),
+    "PNG": ("1", "L", "LA", "I", "I;16", "RGB"),
+    "WEBP": ("L", "RGB")
+}
+
+def convert_image_for_api(image_data: bytes, profile: str = "png-fast") -> ReferenceImage:
+    """Convert uploaded image to the encoded reference sent to the OpenAI API.
+
+    Runs inside the preprocessing process pool, so it takes and returns
+    plain picklable values and raises ordinary exceptions.
+    """
+    # Image.open only parses the header, so size and format are known before decoding
+    img = Image.open(io.BytesIO(image_data))
+    width, height = img.size
+    max_dimension = 1024
+    
+    new_width, new_height = width, height
+    if width > max_dimension or height > max_dimension:
+        if width > height:
+            new_height = int((height * max_dimension) / width)
+            new_width = max_dimension
+        else:
+            new_width = int((width * max_dimension) / height)
+            new_height = max_dimension
         
-        base64_data = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-        return f"data:image/png;base64,{base64_data}"
+        if img.format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the target size
+            img.draft("RGB", (new_width, new_height))
+    
+    # Convert to RGB if necessary (alpha is dropped; JPEG can't store 16-bit samples either)
+    encoding = REFERENCE_ENCODING_PROFILES[profile]
+    if img.mode not in ENCODER_MODES[encoding["format"]]:
+        if img.mode == "I" or img.mode.startswith("I;16"):
+            # 16-bit grayscale: scale to 8 bits instead of clipping to white
+            img = img.convert("I").point(lambda v: v / 256).convert("L")
+        else:
+            img = img.convert("RGB")
     
+    # Resize if still too large (reducing_gap shrinks by whole factors first)
+    if img.size != (new_width, new_height):
+        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    
+    # Encode once; these bytes go straight to the SDK
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format=encoding["format"], **encoding["options"])
+    return ReferenceImage(
+        data=img_buffer.getvalue(),
+        mime_type=encoding["mime_type"],
+        filename=f"reference.{encoding['extension']}"
+    )
+
+# Reference image preprocessing pool (0 workers = run in a thread instead)
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count() or 2)))
+PREPROCESS_MAX_PENDING = int(os.getenv("PREPROCESS_MAX_PENDING", str(max(PREPROCESS_WORKERS, 1) * 4)))
+PREPROCESS_WAIT_TIMEOUT = float(os.getenv("PREPROCESS_WAIT_TIMEOUT", "10"))
+
+preprocess_pool: Optional[ProcessPoolExecutor] = None
+preprocess_slots: Optional[asyncio.Semaphore] = None
+preprocess_stats = {"count": 0, "rejected": 0, "in_flight": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+@app.on_event("startup")
+async def startup_preprocess_pool():
+    """Start the process pool used for reference image preprocessing"""
+    global preprocess_pool, preprocess_slots
+    preprocess_slots = asyncio.Semaphore(PREPROCESS_MAX_PENDING)
+    if PREPROCESS_WORKERS > 0:
+        preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+    print(f"🧮 Preprocessing pool: {PREPROCESS_WORKERS} processes, {PREPROCESS_MAX_PENDING} pending max")
+
+@app.on_event("shutdown")
+async def shutdown_preprocess_pool():
+    """Stop the preprocessing process pool"""
+    global preprocess_pool
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown(wait=False, cancel_futures=True)
+        preprocess_pool = None
+
+def restart_preprocess_pool(broken: ProcessPoolExecutor):
+    """Replace a pool whose worker died (e.g. OOM-killed); later jobs would all fail otherwise"""
+    global preprocess_pool
+    if preprocess_pool is not broken:
+        return  # another caller already replaced it
+    print(f"♻️ Preprocessing pool broken, starting a new one")
+    broken.shutdown(wait=False, cancel_futures=True)
+    preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+
+def is_bad_image_error(error: Exception) -> bool:
+    """Decoder failures caused by the upload itself, as opposed to server faults"""
+    if isinstance(error, (Image.UnidentifiedImageError, Image.DecompressionBombError, SyntaxError)):
+        return True
+    # PIL raises errno-less OSErrors for truncated or corrupt data; real I/O errors carry an errno
+    return isinstance(error, OSError) and error.errno is None
+
+async def run_in_preprocess_pool(func, *args, wait_timeout: Optional[float] = PREPROCESS_WAIT_TIMEOUT) -> tuple:
+    """Run an image job in the preprocessing pool and return (result, elapsed_ms).
+
+    Raises 503 when the pool already has PREPROCESS_MAX_PENDING jobs
+    queued for longer than wait_timeout seconds (None waits for a slot)
+    or a worker died, 400 when the image can't be decoded and 500 for
+    anything else.
+    """
+    slots = preprocess_slots or asyncio.Semaphore(PREPROCESS_MAX_PENDING)
+    try:
+        await asyncio.wait_for(slots.acquire(), timeout=wait_timeout)
+    except asyncio.TimeoutError:
+        preprocess_stats["rejected"] += 1
+        raise HTTPException(status_code=503, detail="Image preprocessing is saturated, try again shortly")
+    
+    preprocess_stats["in_flight"] += 1
+    started = time.perf_counter()
+    pool = preprocess_pool
+    try:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        restart_preprocess_pool(pool)
+        raise HTTPException(status_code=503, detail="Image preprocessing restarted, try again shortly",
+                            headers={"Retry-After": "1"})
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
+        if is_bad_image_error(e):
+            raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
+        print(f"❌ Image processing failed: {type(e).__name__}: {e}")
+        raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
+    finally:
+        preprocess_stats["in_flight"] -= 1
+        slots.release()
+    
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    preprocess_stats["count"] += 1
+    preprocess_stats["total_ms"] += elapsed_ms
+    preprocess_stats["max_ms"] = max(preprocess_stats["max_ms"], elapsed_ms)
+    return result, round(elapsed_ms, 1)
+
+async def preprocess_reference_image(image_data: bytes, profile: str = "png-fast",
+                                     wait_timeout: Optional[float] = PREPROCESS_WAIT_TIMEOUT) -> tuple:
+    """Run convert_image_for_api off the event loop and return (ReferenceImage, elapsed_ms)"""
+    return await run_in_preprocess_pool(convert_image_for_api, image_data, profile, wait_timeout=wait_timeout)
+
+def preprocess_stats_summary() -> dict:
+    """Preprocessing stage timings for /health"""
+    count = preprocess_stats["count"]
+    return {
+        "workers": PREPROCESS_WORKERS,
+        "processed": count,
+        "rejected": preprocess_stats["rejected"],
+        "in_flight": preprocess_stats["in_flight"],
+        "avg_ms": round(preprocess_stats["total_ms"] / count, 1) if count else 0.0,
+        "max_ms": round(preprocess_stats["max_ms"], 1)
+    }
 
 def generate_style_prompt(template_id: str, style_params: dict) -> str:
     """Generate optimized prompts for cartoon and image transformation"""
@@ -191,152 +427,1976 @@ def generate_style_prompt(template_id: str, style_params: dict) -> str:
     
     return template_config["base"]
 
-async def generate_image_gpt_image_1(prompt: str, reference_image: Optional[str] = None, 
+# Upstream rate limiting: request and image-token budgets shared by every OpenAI image call
+UPSTREAM_RPM = int(os.getenv("UPSTREAM_RPM", "50"))
+UPSTREAM_TPM = int(os.getenv("UPSTREAM_TPM", "100000"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "120"))
+UPSTREAM_RATE_LIMIT_RETRIES = int(os.getenv("UPSTREAM_RATE_LIMIT_RETRIES", "3"))
+
+# gpt-image-1 output tokens by (quality, size), as in the Streamlit cost calculator
+IMAGE_OUTPUT_TOKENS = {
+    ("low", "1024x1024"): 272, ("low", "1024x1536"): 408, ("low", "1536x1024"): 400,
+    ("medium", "1024x1024"): 1056, ("medium", "1024x1536"): 1584, ("medium", "1536x1024"): 1568,
+    ("high", "1024x1024"): 4160, ("high", "1024x1536"): 6240, ("high", "1536x1024"): 6208,
+}
+# Rough input cost of one reference image, same estimate as the calculator
+REFERENCE_IMAGE_TOKENS = 1000
+
+def estimate_image_tokens(quality: str, size: str, reference_image: Optional[ReferenceImage]) -> int:
+    tokens = IMAGE_OUTPUT_TOKENS.get((quality, size), 1056)
+    return tokens + (REFERENCE_IMAGE_TOKENS if reference_image else 0)
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """OpenAI reset headers look like "1s", "6m0s" or "20ms"; Retry-After is plain seconds"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    unit_seconds = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * unit_seconds[unit] for amount, unit in parts)
+
+class TokenBucket:
+    """Budget of `per_minute` units that refills continuously"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available (never more than a full bucket is asked for)"""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing * 60 / self.capacity) if self.capacity > 0 else 0.0
+
+    def take(self, amount: float):
+        self.available -= min(amount, self.capacity)
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], now: float):
+        """Adopt the limit and remaining budget the server reports"""
+        self._refill(now)
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.available = min(self.available, remaining)
+
+class UpstreamRateLimiter:
+    """Admits upstream calls first-come first-served once both budgets allow.
+
+    Callers wait instead of failing; budgets follow the x-ratelimit-*
+    headers of each response, and a 429 pauses everyone for Retry-After.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.in_flight = 0
+        self.stats = {"admitted": 0, "throttled": 0, "timed_out": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+
+    async def acquire(self, tokens: int):
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            # asyncio.Lock wakes waiters in order, so the head of the queue is never overtaken
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    delay = max(self.paused_until - now, self.requests.wait_time(1, now),
+                                self.tokens.wait_time(tokens, now))
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+        finally:
+            self.waiting -= 1
+        
+        waited_ms = (time.monotonic() - started) * 1000
+        self.stats["admitted"] += 1
+        self.stats["total_wait_ms"] += waited_ms
+        self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], waited_ms)
+
+    def observe(self, headers):
+        """Follow the budgets reported on a successful response"""
+        now = time.monotonic()
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is None and remaining is None:
+                continue
+            try:
+                bucket.sync(float(limit) if limit else None, float(remaining) if remaining else None, now)
+            except ValueError:
+                continue
+            reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining is not None and float(remaining) <= 0 and reset:
+                self.paused_until = max(self.paused_until, now + reset)
+
+    def throttled(self, headers) -> float:
+        """Pause every caller after a 429 and return how long for"""
+        self.stats["throttled"] += 1
+        delay = (parse_reset_duration(headers.get("retry-after"))
+                 or parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+                 or parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+                 or 1.0)
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + delay)
+        self.requests.sync(None, 0, now)
+        return delay
+
+    def retry_after(self) -> int:
+        """Seconds a client turned away now should wait before trying again"""
+        now = time.monotonic()
+        return max(1, math.ceil(max(self.paused_until - now, self.requests.wait_time(self.waiting + 1, now))))
+
+    def summary(self) -> dict:
+        admitted = self.stats["admitted"]
+        return {
+            "rpm": round(self.requests.capacity),
+            "tpm": round(self.tokens.capacity),
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "paused_for_s": round(max(0.0, self.paused_until - time.monotonic()), 1),
+            "admitted": admitted,
+            "throttled": self.stats["throttled"],
+            "timed_out": self.stats["timed_out"],
+            "avg_wait_ms": round(self.stats["total_wait_ms"] / admitted, 1) if admitted else 0.0,
+            "max_wait_ms": round(self.stats["max_wait_ms"], 1)
+        }
+
+upstream_limiter = UpstreamRateLimiter(UPSTREAM_RPM, UPSTREAM_TPM)
+
+# Transient upstream failures (timeouts, connection errors, 5xx) are retried with full-jitter backoff
+UPSTREAM_ERROR_RETRIES = int(os.getenv("UPSTREAM_ERROR_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))
+# Let the standard routing policy fall back to DALL-E when gpt-image-1 is missing or its breaker is open
+UPSTREAM_FALLBACK = os.getenv("UPSTREAM_FALLBACK", "true").lower() == "true"
+
+# Circuit breakers, one per model and endpoint
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+
+def is_transient_error(error: Exception) -> bool:
+    """Errors worth retrying: the request may succeed as-is a moment later"""
+    if isinstance(error, openai.APIConnectionError):  # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+def is_model_missing(error: Exception) -> bool:
+    return isinstance(error, openai.NotFoundError) or getattr(error, "code", None) == "model_not_found"
+
+def backoff_delay(attempt: int) -> float:
+    """Full jitter: uniform between 0 and the capped exponential step"""
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while a breaker is open"""
+
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(f"{key} circuit open")
+        self.key = key
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Opens after BREAKER_FAILURE_THRESHOLD consecutive transient failures.
+
+    While open every call fails fast; after BREAKER_OPEN_SECONDS one trial
+    call is let through (half-open) and its outcome closes or reopens it.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at = None
+        self.stats = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def refresh(self):
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_OPEN_SECONDS:
+            self.state = "half_open"
+            self.trial_started_at = None
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.refresh()
+        if self.state == "half_open":
+            # One trial at a time; a trial that never reported back (cancelled) is replaced
+            if self.trial_started_at is None or now - self.trial_started_at >= BREAKER_OPEN_SECONDS:
+                self.trial_started_at = now
+                return True
+        if self.state == "closed":
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def record_success(self):
+        self.stats["successes"] += 1
+        self.consecutive_failures = 0
+        if self.state != "closed":
+            print(f"✅ Circuit {self.key} closed")
+        self.state = "closed"
+
+    def record_failure(self):
+        self.stats["failures"] += 1
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+            if self.state != "open":
+                self.stats["opened"] += 1
+                print(f"🔌 Circuit {self.key} open for {BREAKER_OPEN_SECONDS:.0f}s")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_after(self) -> float:
+        if self.state != "open":
+            return 1.0
+        return max(1.0, BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at))
+
+    def summary(self) -> dict:
+        self.refresh()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after_s": round(self.retry_after(), 1) if self.state == "open" else None,
+            **self.stats
+        }
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(key: str) -> CircuitBreaker:
+    breaker = circuit_breakers.get(key)
+    if breaker is None:
+        breaker = circuit_breakers[key] = CircuitBreaker(key)
+    return breaker
+
+for breaker_key in ("gpt-image-1:edit", "gpt-image-1:generate", "dall-e-3:generate", "dall-e-2:create_variation"):
+    get_circuit_breaker(breaker_key)
+
+async def call_image_api(operation: str, tokens: int, **kwargs):
+    """Call client.images.<operation> once the rate limiter and circuit breaker admit it.
+
+    429s pause the limiter and the call queues again; transient errors are
+    retried with jittered backoff and counted by the breaker. Raises
+    CircuitOpenError without calling upstream while the breaker is open.
+    """
+    # The SDK's own retries would bypass the limiter and breaker, so retries happen here
+    client = get_openai_client().with_options(max_retries=0)
+    operation_call = getattr(client.images.with_raw_response, operation)
+    breaker = get_circuit_breaker(f"{kwargs.get('model', 'dall-e-2')}:{operation}")
+    rate_limited = errors = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.key, breaker.retry_after())
+        try:
+            await asyncio.wait_for(upstream_limiter.acquire(tokens), timeout=UPSTREAM_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            upstream_limiter.stats["timed_out"] += 1
+            raise HTTPException(status_code=429, detail="Image generation is busy, try again shortly",
+                                headers={"Retry-After": str(upstream_limiter.retry_after())})
+        upstream_limiter.in_flight += 1
+        try:
+            raw = await operation_call(**kwargs)
+        except openai.RateLimitError as e:
+            if getattr(e, "code", None) == "insufficient_quota":
+                raise HTTPException(status_code=503, detail="OpenAI quota exhausted")
+            delay = upstream_limiter.throttled(e.response.headers)
+            rate_limited += 1
+            if rate_limited > UPSTREAM_RATE_LIMIT_RETRIES:
+                raise HTTPException(status_code=429, detail="OpenAI rate limit reached, try again shortly",
+                                    headers={"Retry-After": str(max(1, math.ceil(delay)))})
+            print(f"⏳ Upstream rate limited, queueing {operation} again in {delay:.1f}s")
+            continue
+        except openai.APIError as e:
+            if not is_transient_error(e):
+                # Upstream answered; the request itself is at fault
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            errors += 1
+            if errors > UPSTREAM_ERROR_RETRIES:
+                raise
+            delay = backoff_delay(errors)
+            print(f"🔁 {breaker.key} failed ({type(e).__name__}), retry {errors}/{UPSTREAM_ERROR_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            upstream_limiter.in_flight -= 1
+        breaker.record_success()
+        upstream_limiter.observe(raw.headers)
+        return raw.parse()
+
+def upstream_unavailable(retry_after: float) -> HTTPException:
+    return HTTPException(status_code=503, detail="Image generation is temporarily unavailable, try again shortly",
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+async def generate_image_gpt_image_1(prompt: str, reference_image: Optional[ReferenceImage] = None, 
                                    quality: str = "medium", size: str = "1024x1024"):
     """Generate image using GPT-image-1 with optimized cartoon prompts"""
-    client = get_openai_client()
+    tokens = estimate_image_tokens(quality, size, reference_image)
     
-    try:
-        if reference_image:
-            # Use GPT-image-1 with reference image (edit endpoint)
-            print(f"🎨 Using GPT-image-1 for image transformation with prompt: {prompt}")
-            
-            # Extract base64 data and convert to bytes
-            _, base64_data = reference_image.split(',', 1)
-            image_bytes = base64.b64decode(base64_data)
-            
-            # Create image buffer for API
-            image_buffer = io.BytesIO(image_bytes)
-            image_buffer.name = "reference.png"
-            image_buffer.seek(0)
-            
-            # Use GPT-image-1 edit endpoint with optimized settings
-            response = client.images.edit(
-                model="gpt-image-1",
-                image=image_buffer,
-                prompt=prompt,
-                size=size
-            )
-            
-            print(f"✅ GPT-image-1 transformation completed successfully")
-            
-        else:
-            # Use GPT-image-1 for text-to-image generation
-            print(f"🎨 Using GPT-image-1 for text-to-image with prompt: {prompt}")
-            
-            response = client.images.generate(
-                model="gpt-image-1",
-                prompt=prompt,
-                size=size,
-                quality=quality,
-                n=1
-            )
-            
-            print(f"✅ GPT-image-1 image generated successfully")
+    if reference_image:
+        # Use GPT-image-1 with reference image (edit endpoint)
+        print(f"🎨 Using GPT-image-1 for image transformation with prompt: {prompt}")
+        
+        # Use GPT-image-1 edit endpoint with optimized settings
+        response = await call_image_api(
+            "edit", tokens,
+            model="gpt-image-1",
+            image=reference_image.as_upload(),
+            prompt=prompt,
+            size=size
+        )
+        
+        print(f"✅ GPT-image-1 transformation completed successfully")
         
-        return response
+    else:
+        # Use GPT-image-1 for text-to-image generation
+        print(f"🎨 Using GPT-image-1 for text-to-image with prompt: {prompt}")
+        
+        response = await call_image_api(
+            "generate", tokens,
+            model="gpt-image-1",
+            prompt=prompt,
+            size=size,
+            quality=quality,
+            n=1
+        )
         
+        print(f"✅ GPT-image-1 image generated successfully")
+    
+    return response
+
+async def generate_dalle_3(prompt: str, reference_image: Optional[ReferenceImage] = None,
+                           quality: str = "medium", size: str = "1024x1024"):
+    """Text-to-image with DALL-E 3 (no reference support)"""
+    response = await call_image_api(
+        "generate", 0,
+        model="dall-e-3",
+        prompt=prompt,
+        size=size,
+        quality="standard" if quality == "low" else "hd" if quality == "high" else "standard",
+        n=1
+    )
+    print(f"✅ DALL-E 3 generation successful")
+    return response
+
+async def generate_dalle_2_variation(prompt: str, reference_image: Optional[ReferenceImage] = None,
+                                     quality: str = "medium", size: str = "1024x1024"):
+    """Variation of the reference photo with DALL-E 2 (ignores the prompt)"""
+    response = await call_image_api(
+        "create_variation", 0,
+        model="dall-e-2",
+        image=reference_image.as_png().as_upload(),
+        n=1,
+        size="1024x1024"
+    )
+    print(f"✅ DALL-E 2 variation successful")
+    return response
+
+class ImageBackend(NamedTuple):
+    generate: Callable
+    reference: bool  # can work from a reference photo
+    text: bool  # can work from a prompt alone
+
+IMAGE_BACKENDS = {
+    "gpt-image-1": ImageBackend(generate_image_gpt_image_1, reference=True, text=True),
+    "dall-e-3": ImageBackend(generate_dalle_3, reference=False, text=True),
+    "dall-e-2": ImageBackend(generate_dalle_2_variation, reference=True, text=False)
+}
+
+def backend_breaker(backend: str, has_reference: bool) -> CircuitBreaker:
+    operation = {"dall-e-3": "generate", "dall-e-2": "create_variation"}.get(
+        backend, "edit" if has_reference else "generate"
+    )
+    return get_circuit_breaker(f"{backend}:{operation}")
+
+# Rolling per-backend statistics used for routing decisions
+ROUTING_WINDOW = int(os.getenv("ROUTING_WINDOW", "100"))
+ROUTING_WINDOW_SECONDS = float(os.getenv("ROUTING_WINDOW_SECONDS", "900"))
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "5"))
+# Share of fastest-policy requests sent to a backend that has too few samples to rank
+ROUTING_PROBE_RATE = float(os.getenv("ROUTING_PROBE_RATE", "0.05"))
+# Hedging bills a second image, so it is opt-in and only applies to policies that allow it
+ROUTING_HEDGING = os.getenv("ROUTING_HEDGING", "false").lower() == "true"
+ROUTING_HEDGE_PERCENTILE = float(os.getenv("ROUTING_HEDGE_PERCENTILE", "90"))
+
+class BackendStats:
+    """Latency of successful calls and outcome of every call within a rolling window"""
+
+    def __init__(self):
+        self.samples = deque(maxlen=ROUTING_WINDOW)  # (monotonic time, latency ms or None on error)
+        self.hedges = 0
+
+    def record(self, latency_ms: Optional[float]):
+        self.samples.append((time.monotonic(), latency_ms))
+
+    def recent(self) -> list:
+        cutoff = time.monotonic() - ROUTING_WINDOW_SECONDS
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return [latency for _, latency in self.samples]
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        latencies = sorted(latency for latency in self.recent() if latency is not None)
+        if len(latencies) < ROUTING_MIN_SAMPLES:
+            return None
+        rank = min(len(latencies) - 1, max(0, math.ceil(percentile / 100 * len(latencies)) - 1))
+        return latencies[rank]
+
+    def error_rate(self) -> float:
+        recent = self.recent()
+        if len(recent) < ROUTING_MIN_SAMPLES:
+            return 0.0
+        return sum(1 for latency in recent if latency is None) / len(recent)
+
+    def summary(self) -> dict:
+        recent = self.recent()
+        p50, p90 = self.latency_percentile(50), self.latency_percentile(90)
+        return {
+            "calls": len(recent),
+            "error_rate": round(self.error_rate(), 3),
+            "p50_ms": round(p50) if p50 is not None else None,
+            "p90_ms": round(p90) if p90 is not None else None,
+            "hedges": self.hedges
+        }
+
+backend_stats: Dict[str, BackendStats] = {name: BackendStats() for name in IMAGE_BACKENDS}
+
+class RoutingPolicy(NamedTuple):
+    backends: Tuple[str, ...]  # acceptable backends in preference order
+    fastest: bool  # reorder by measured p50 latency instead of preference
+    hedge: bool  # may fire the next backend when the first is slow
+
+ROUTING_POLICIES = {
+    # gpt-image-1, falling back to DALL-E only while it is unavailable
+    "standard": RoutingPolicy(("gpt-image-1", "dall-e-3", "dall-e-2") if UPSTREAM_FALLBACK else ("gpt-image-1",),
+                              fastest=False, hedge=False),
+    # Previews take whichever styled backend currently answers fastest; DALL-E 2 variations
+    # ignore the prompt, so they are not acceptable here
+    "preview": RoutingPolicy(("gpt-image-1", "dall-e-3"), fastest=True, hedge=True),
+    # Print renders must come from gpt-image-1
+    "print": RoutingPolicy(("gpt-image-1",), fastest=False, hedge=False)
+}
+
+ROUTING_DEFAULT_POLICY = os.getenv("ROUTING_DEFAULT_POLICY", "standard")
+
+# Templates that always use one policy whatever the client asks for, e.g. {"cover-shoot": "print"}
+TEMPLATE_ROUTING_POLICIES: Dict[str, str] = {}
+
+def routing_policy_for(template_id: str, purpose: Optional[str] = None) -> str:
+    """Pick the routing policy: template override, then requested purpose, then the default"""
+    policy = TEMPLATE_ROUTING_POLICIES.get(template_id) or purpose or ROUTING_DEFAULT_POLICY
+    if policy not in ROUTING_POLICIES:
+        raise HTTPException(status_code=400, detail=f"Unknown purpose '{policy}'")
+    return policy
+
+def routing_candidates(policy: RoutingPolicy, has_reference: bool) -> List[str]:
+    """Acceptable backends for this request, best first.
+
+    Backends whose breaker is open go last; they are only tried when
+    nothing healthier is left. Demotion follows the breaker alone, so a
+    recovered backend gets traffic back through its half-open trial
+    instead of waiting for its old errors to age out. Fastest
+    policies rank measured backends by p50 latency; backends without
+    enough samples follow them in preference order, and one of them is
+    moved to the front for ROUTING_PROBE_RATE of requests so it gets measured.
+    """
+    capable = [name for name in policy.backends
+               if (IMAGE_BACKENDS[name].reference if has_reference else IMAGE_BACKENDS[name].text)]
+
+    def unhealthy(name: str) -> bool:
+        return backend_breaker(name, has_reference).summary()["state"] == "open"
+
+    if not policy.fastest:
+        return sorted(capable, key=unhealthy)
+
+    latencies = {name: backend_stats[name].latency_percentile(50) for name in capable}
+    ranked = sorted(capable, key=lambda name: (unhealthy(name), latencies[name] is None,
+                                               latencies[name] or capable.index(name)))
+    unmeasured = [name for name in ranked if latencies[name] is None and not unhealthy(name)]
+    if unmeasured and len(unmeasured) < len(ranked) and random.random() < ROUTING_PROBE_RATE:
+        ranked.remove(unmeasured[0])
+        ranked.insert(0, unmeasured[0])
+    return ranked
+
+async def call_backend(name: str, prompt: str, reference_image: Optional[ReferenceImage],
+                       quality: str, size: str) -> tuple:
+    """Run one backend and record its latency or transient failure; returns (response, backend)"""
+    started = time.perf_counter()
+    try:
+        response = await IMAGE_BACKENDS[name].generate(prompt, reference_image, quality, size)
     except Exception as e:
-        error_msg = str(e)
-        print(f"❌ GPT-image-1 generation failed: {error_msg}")
+        if is_transient_error(e):
+            backend_stats[name].record(None)
+        raise
+    backend_stats[name].record((time.perf_counter() - started) * 1000)
+    return response, name
+
+async def hedged_call(primary: str, secondary: str, hedge_after: float, *args):
+    """Start primary; if it is still running after hedge_after seconds, race secondary against it"""
+    started = time.perf_counter()
+    tasks = {asyncio.create_task(call_backend(primary, *args)): (primary, started)}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if done:
+            return done.pop().result()
+        print(f"🏁 {primary} slower than p{ROUTING_HEDGE_PERCENTILE:.0f} ({hedge_after:.1f}s), hedging with {secondary}")
+        backend_stats[secondary].hedges += 1
+        tasks[asyncio.create_task(call_backend(secondary, *args))] = (secondary, time.perf_counter())
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    # The loser took at least this long; record it so a slow backend stops looking fast
+                    for loser in pending:
+                        name, loser_started = tasks[loser]
+                        backend_stats[name].record((time.perf_counter() - loser_started) * 1000)
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        # The loser (or both, if the client went away) is abandoned
+        for task in tasks:
+            task.cancel()
+
+async def route_image_generation(prompt: str, reference_image: Optional[ReferenceImage] = None,
+                                 quality: str = "medium", size: str = "1024x1024",
+                                 policy_name: str = "standard") -> tuple:
+    """Generate an image on the best backend the routing policy allows; returns (response, backend)"""
+    policy = ROUTING_POLICIES[policy_name]
+    candidates = routing_candidates(policy, reference_image is not None)
+    if not candidates:
+        raise HTTPException(status_code=400, detail=f"No {policy_name} backend supports this request")
+    
+    unavailable = None
+    for position, name in enumerate(candidates):
+        try:
+            hedge_after = None
+            if policy.hedge and ROUTING_HEDGING and position + 1 < len(candidates):
+                hedge_after = backend_stats[name].latency_percentile(ROUTING_HEDGE_PERCENTILE)
+            if hedge_after is not None:
+                return await hedged_call(name, candidates[position + 1], hedge_after / 1000,
+                                         prompt, reference_image, quality, size)
+            return await call_backend(name, prompt, reference_image, quality, size)
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"❌ {name} generation failed: {e}")
+            if is_model_missing(e) or isinstance(e, CircuitOpenError):
+                # Backend is unavailable right now; try the next acceptable one
+                unavailable = e
+                if position + 1 < len(candidates):
+                    print(f"🔄 {name} not available, falling back to {candidates[position + 1]}...")
+                continue
+            if is_transient_error(e):
+                raise upstream_unavailable(UPSTREAM_BACKOFF_MAX)
+            raise HTTPException(status_code=500, detail=f"AI generation failed: {e}")
+    
+    retry_after = min((backend_breaker(name, reference_image is not None).retry_after() for name in candidates),
+                      default=UPSTREAM_BACKOFF_MAX)
+    if isinstance(unavailable, CircuitOpenError):
+        raise upstream_unavailable(retry_after)
+    raise HTTPException(status_code=500, detail=f"AI generation failed: {unavailable}")
+
+# Durability of saved images: "none", "file" (fsync the file) or "dir" (file and directory)
+IMAGE_FSYNC_POLICY = os.getenv("IMAGE_FSYNC_POLICY", "none").lower()
+
+def fsync_directory(directory: Path):
+    """Flush a directory entry so a completed rename survives power loss (POSIX only)"""
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@asynccontextmanager
+async def open_atomic(file_path: Path):
+    """Open a temp file next to file_path and rename it into place once fully written.
+
+    Readers only ever see the old file or the complete new one; on error
+    the temp file is removed and file_path is left untouched.
+    """
+    tmp_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        async with aiofiles.open(tmp_path, "wb") as f:
+            yield f
+            await f.flush()
+            if IMAGE_FSYNC_POLICY in ("file", "dir"):
+                await asyncio.to_thread(os.fsync, f.fileno())
+        await aiofiles.os.replace(tmp_path, file_path)
+        if IMAGE_FSYNC_POLICY == "dir":
+            await asyncio.to_thread(fsync_directory, file_path.parent)
+    except BaseException:
+        if await aiofiles.os.path.exists(tmp_path):
+            await aiofiles.os.remove(tmp_path)
+        raise
+
+# Generated image storage: content-addressed names in hash-sharded directories
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "local").lower()
+STORAGE_SHARD_DEPTH = int(os.getenv("STORAGE_SHARD_DEPTH", "2"))
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "http://localhost:9000")
+S3_BUCKET = os.getenv("S3_BUCKET", "generated-images")
+S3_PREFIX = os.getenv("S3_PREFIX", "")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID", "")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY", "")
+
+# <sha256>.png plus derivatives such as <sha256>.w512.webp share the same shard
+CONTENT_FILENAME_RE = re.compile(r"^([0-9a-f]{64})\.[\w.]+$")
+
+class StoredImage(NamedTuple):
+    """Where a saved image ended up"""
+    filename: str
+    location: str
+    size: int
+    deduplicated: bool = False
+
+def content_filename(digest: str) -> str:
+    return f"{digest}.png"
+
+def shard_parts(filename: str) -> List[str]:
+    """Shard directories for a content-addressed name; legacy names stay flat"""
+    match = CONTENT_FILENAME_RE.match(filename)
+    if not match:
+        return []
+    digest = match.group(1)
+    return [digest[i * 2:i * 2 + 2] for i in range(STORAGE_SHARD_DEPTH)]
+
+def validate_filename(filename: str):
+    """Reject names that could escape the storage root"""
+    if not filename or "/" in filename or "\\" in filename or filename.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid image filename")
+
+class LocalImageStorage:
+    """Images under generated-images/ab/cd/<sha256>.png, written atomically"""
+
+    def __init__(self, base_dir: Path):
+        self.base_dir = base_dir
+
+    def path_for(self, filename: str) -> Path:
+        return self.base_dir.joinpath(*shard_parts(filename), filename)
+
+    def local_path(self, filename: str) -> Optional[Path]:
+        validate_filename(filename)
+        return self.path_for(filename)
+
+    async def exists(self, filename: str) -> bool:
+        return await aiofiles.os.path.exists(self.path_for(filename))
+
+    async def save(self, data: bytes) -> StoredImage:
+        filename = content_filename(hashlib.sha256(data).hexdigest())
+        path = self.path_for(filename)
+        if await aiofiles.os.path.exists(path):
+            return StoredImage(filename, str(path), len(data), deduplicated=True)
         
-        # Fallback to DALL-E if GPT-image-1 is not available
-        if "model" in error_msg.lower() and ("not found" in error_msg.lower() or "does not exist" in error_msg.lower()):
-            print(f"🔄 GPT-image-1 not available, falling back to DALL-E...")
+        await aiofiles.os.makedirs(path.parent, exist_ok=True)
+        async with open_atomic(path) as f:
+            await f.write(data)
+        return StoredImage(filename, str(path), len(data))
+
+    async def save_stream(self, chunks) -> StoredImage:
+        """Write chunks to a temp file while hashing, then move it to its content address"""
+        tmp_path = self.base_dir / f".incoming-{uuid.uuid4().hex[:8]}.tmp"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await f.write(chunk)
+                await f.flush()
+                if IMAGE_FSYNC_POLICY in ("file", "dir"):
+                    await asyncio.to_thread(os.fsync, f.fileno())
             
-            if reference_image:
-                # Use DALL-E 2 for variations
-                image_buffer = io.BytesIO(base64.b64decode(reference_image.split(',', 1)[1]))
-                image_buffer.name = "reference.png"
-                image_buffer.seek(0)
-                
-                response = client.images.create_variation(
-                    image=image_buffer,
-                    n=1,
-                    size="1024x1024"
-                )
-                print(f"✅ DALL-E 2 variation fallback successful")
-            else:
-                # Use DALL-E 3 for generation
-                response = client.images.generate(
-                    model="dall-e-3",
-                    prompt=prompt,
-                    size=size,
-                    quality="standard" if quality == "low" else "hd" if quality == "high" else "standard",
-                    n=1
-                )
-                print(f"✅ DALL-E 3 fallback successful")
+            filename = content_filename(digest.hexdigest())
+            path = self.path_for(filename)
+            if await aiofiles.os.path.exists(path):
+                await aiofiles.os.remove(tmp_path)
+                return StoredImage(filename, str(path), size, deduplicated=True)
             
-            return response
+            await aiofiles.os.makedirs(path.parent, exist_ok=True)
+            await aiofiles.os.replace(tmp_path, path)
+            if IMAGE_FSYNC_POLICY == "dir":
+                await asyncio.to_thread(fsync_directory, path.parent)
+            return StoredImage(filename, str(path), size)
+        except BaseException:
+            if await aiofiles.os.path.exists(tmp_path):
+                await aiofiles.os.remove(tmp_path)
+            raise
+
+    async def put(self, filename: str, data: bytes, content_type: str):
+        """Write bytes under an explicit name (used for derivatives)"""
+        path = self.path_for(filename)
+        await aiofiles.os.makedirs(path.parent, exist_ok=True)
+        async with open_atomic(path) as f:
+            await f.write(data)
+
+    async def read(self, filename: str) -> bytes:
+        async with aiofiles.open(self.path_for(filename), "rb") as f:
+            return await f.read()
+
+    async def delete(self, filename: str):
+        path = self.path_for(filename)
+        if await aiofiles.os.path.exists(path):
+            await aiofiles.os.remove(path)
+
+    async def close(self):
+        pass
+
+class S3ImageStorage:
+    """Images in an S3-compatible bucket (AWS, MinIO, ...) using path-style SigV4 requests"""
+
+    def __init__(self, endpoint_url: str, bucket: str, access_key: str, secret_key: str,
+                 region: str = "us-east-1", prefix: str = ""):
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.host = urlsplit(self.endpoint_url).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip("/")
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        )
+
+    def key_for(self, filename: str) -> str:
+        parts = ([self.prefix] if self.prefix else []) + shard_parts(filename) + [filename]
+        return "/".join(parts)
+
+    def local_path(self, filename: str) -> Optional[Path]:
+        validate_filename(filename)
+        return None
+
+    def _signed_headers(self, method: str, path: str, payload_hash: str) -> dict:
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = now.strftime("%Y%m%d")
+        canonical_headers = f"host:{self.host}\nx-amz-content-sha256:{payload_hash}\nx-amz-date:{amz_date}\n"
+        signed_headers = "host;x-amz-content-sha256;x-amz-date"
+        canonical_request = "\n".join([method, path, "", canonical_headers, signed_headers, payload_hash])
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope,
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+        ])
+        signing_key = f"AWS4{self.secret_key}".encode("utf-8")
+        for part in (datestamp, self.region, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode("utf-8"), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        return {
+            "x-amz-date": amz_date,
+            "x-amz-content-sha256": payload_hash,
+            "Authorization": (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                              f"SignedHeaders={signed_headers}, Signature={signature}")
+        }
+
+    async def _request(self, method: str, filename: str, content: bytes = b"",
+                       headers: Optional[dict] = None) -> httpx.Response:
+        path = "/" + quote(f"{self.bucket}/{self.key_for(filename)}", safe="/-_.~")
+        request_headers = self._signed_headers(method, path, hashlib.sha256(content).hexdigest())
+        request_headers.update(headers or {})
+        return await self.client.request(method, self.endpoint_url + path,
+                                         content=content or None, headers=request_headers)
+
+    async def exists(self, filename: str) -> bool:
+        response = await self._request("HEAD", filename)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    async def save(self, data: bytes) -> StoredImage:
+        filename = content_filename(hashlib.sha256(data).hexdigest())
+        location = f"s3://{self.bucket}/{self.key_for(filename)}"
+        if await self.exists(filename):
+            return StoredImage(filename, location, len(data), deduplicated=True)
+        response = await self._request("PUT", filename, data, {"Content-Type": "image/png"})
+        response.raise_for_status()
+        return StoredImage(filename, location, len(data))
+
+    async def save_stream(self, chunks) -> StoredImage:
+        # The object key is the content hash, so the body has to be complete before the PUT
+        return await self.save(b"".join([chunk async for chunk in chunks]))
+
+    async def put(self, filename: str, data: bytes, content_type: str):
+        response = await self._request("PUT", filename, data, {"Content-Type": content_type})
+        response.raise_for_status()
+
+    async def read(self, filename: str) -> bytes:
+        response = await self._request("GET", filename)
+        if response.status_code == 404:
+            raise FileNotFoundError(filename)
+        response.raise_for_status()
+        return response.content
+
+    async def delete(self, filename: str):
+        response = await self._request("DELETE", filename)
+        if response.status_code not in (200, 204, 404):
+            response.raise_for_status()
+
+    async def close(self):
+        await self.client.aclose()
+
+image_storage = None
+
+def get_image_storage():
+    """Return the configured storage backend (IMAGE_STORAGE=local or s3)"""
+    global image_storage
+    if image_storage is None:
+        if IMAGE_STORAGE == "s3":
+            image_storage = S3ImageStorage(S3_ENDPOINT_URL, S3_BUCKET, S3_ACCESS_KEY_ID,
+                                           S3_SECRET_ACCESS_KEY, S3_REGION, S3_PREFIX)
         else:
-            raise HTTPException(status_code=500, detail=f"AI generation failed: {error_msg}")
+            image_storage = LocalImageStorage(ensure_directories())
+    return image_storage
+
+@app.on_event("shutdown")
+async def shutdown_image_storage():
+    global image_storage
+    if image_storage is not None:
+        await image_storage.close()
+        image_storage = None
+
+# Recently written images kept in memory; they are fetched several times right after generation
+HOT_CACHE_MAX_BYTES = int(os.getenv("HOT_CACHE_MAX_BYTES", str(128 * 1024 ** 2)))
+HOT_CACHE_MAX_ITEM_BYTES = int(os.getenv("HOT_CACHE_MAX_ITEM_BYTES", str(8 * 1024 ** 2)))
+
+class HotImageCache:
+    """Byte-bounded LRU of image bytes keyed by stored filename"""
 
-def save_generated_image(base64_data: str, template_id: str) -> tuple:
-    """Save generated image and return path and filename"""
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.items: "OrderedDict[str, bytes]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.items
+
+    def get(self, filename: str) -> Optional[bytes]:
+        data = self.items.get(filename)
+        if data is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(filename)
+        self.hits += 1
+        return data
+
+    def put(self, filename: str, data: bytes):
+        if len(data) > self.max_item_bytes or self.max_bytes <= 0:
+            return
+        self.discard(filename)
+        self.items[filename] = data
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def discard(self, filename: str):
+        data = self.items.pop(filename, None)
+        if data is not None:
+            self.total_bytes -= len(data)
+
+    def stats(self) -> dict:
+        return {"items": len(self.items), "bytes": self.total_bytes, "hits": self.hits, "misses": self.misses}
+
+hot_images = HotImageCache(HOT_CACHE_MAX_BYTES, HOT_CACHE_MAX_ITEM_BYTES)
+
+async def save_generated_image(base64_data: str) -> StoredImage:
+    """Save generated image under its content address"""
     try:
         image_bytes = base64.b64decode(base64_data)
-        
-        timestamp = int(time.time())
-        random_id = str(uuid.uuid4())[:8]
-        filename = f"{template_id}-{timestamp}-{random_id}.png"
-        
-        generated_dir = ensure_directories()
-        file_path = generated_dir / filename
-        
-        with open(file_path, 'wb') as f:
-            f.write(image_bytes)
-        
-        return str(file_path), filename
+        stored = await get_image_storage().save(image_bytes)
+        hot_images.put(stored.filename, image_bytes)
+        return stored
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error saving image: {str(e)}")
 
+# Preview derivatives rendered in the background after each save
+DERIVATIVE_WIDTHS = tuple(sorted(int(w) for w in os.getenv("DERIVATIVE_WIDTHS", "256,512,768").split(",") if w))
+DERIVATIVE_QUALITY = int(os.getenv("DERIVATIVE_QUALITY", "80"))
+# Full-size lossy WebP for ?format=webp; opt-in, since plain /image URLs always serve the original
+FULL_WEBP_VARIANT = os.getenv("FULL_WEBP_VARIANT", "false").lower() == "true"
+FULL_WEBP_QUALITY = int(os.getenv("FULL_WEBP_QUALITY", "90"))
+FULL_SIZE = 0
+# Derivative jobs share the preprocessing pool with uploads; cap how many slots they hold
+DERIVATIVE_CONCURRENCY = int(os.getenv("DERIVATIVE_CONCURRENCY", "1"))
+
+derivative_tasks: Dict[str, asyncio.Task] = {}
+derivative_slots: Optional[asyncio.Semaphore] = None
+
+def derivative_filename(filename: str, width: int) -> str:
+    """<name>.png -> <name>.w<width>.webp, or <name>.full.webp for FULL_SIZE"""
+    suffix = "full" if width == FULL_SIZE else f"w{width}"
+    return f"{filename.rsplit('.', 1)[0]}.{suffix}.webp"
+
+def derivative_widths() -> List[int]:
+    """Every derivative kept per image, including the full-size variant when enabled"""
+    return ([FULL_SIZE] if FULL_WEBP_VARIANT else []) + list(DERIVATIVE_WIDTHS)
+
+def media_type_for(filename: str) -> str:
+    extension = filename.rsplit(".", 1)[-1].lower()
+    return {"webp": "image/webp", "jpg": "image/jpeg", "jpeg": "image/jpeg"}.get(extension, "image/png")
+
+def render_derivatives(image_data: bytes, widths: tuple, quality: int, full_quality: int) -> Dict[int, bytes]:
+    """Encode WebP previews at each width narrower than the source (runs in the process pool)"""
+    img = Image.open(io.BytesIO(image_data))
+    img.load()
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    
+    derivatives = {}
+    if FULL_SIZE in widths:
+        buffer = io.BytesIO()
+        img.save(buffer, format="WEBP", quality=full_quality, method=4)
+        derivatives[FULL_SIZE] = buffer.getvalue()
+        widths = tuple(w for w in widths if w != FULL_SIZE)
+    
+    # Shrink largest first so each step resamples from the previous, smaller image
+    for width in sorted(widths, reverse=True):
+        if width >= img.width:
+            continue
+        height = max(1, round(img.height * width / img.width))
+        img = img.resize((width, height), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format="WEBP", quality=quality, method=4)
+        derivatives[width] = buffer.getvalue()
+    return derivatives
+
+async def build_derivatives(filename: str):
+    """Render and store the preview derivatives of one image"""
+    storage = get_image_storage()
+    missing = [w for w in derivative_widths() if not await storage.exists(derivative_filename(filename, w))]
+    if not missing:
+        return
+    
+    global derivative_slots
+    if derivative_slots is None:
+        derivative_slots = asyncio.Semaphore(DERIVATIVE_CONCURRENCY)
+    async with derivative_slots:
+        image_data = hot_images.get(filename) or await storage.read(filename)
+        # Counted against PREPROCESS_MAX_PENDING like uploads, so back-pressure still holds
+        derivatives, _ = await run_in_preprocess_pool(
+            render_derivatives, image_data, tuple(missing), DERIVATIVE_QUALITY, FULL_WEBP_QUALITY
+        )
+    if not derivatives:
+        # Source is already narrower than every preview width
+        return
+    for width, data in derivatives.items():
+        await storage.put(derivative_filename(filename, width), data, "image/webp")
+        hot_images.put(derivative_filename(filename, width), data)
+    await get_metadata_index().add_bytes(filename, sum(len(data) for data in derivatives.values()))
+    print(f"🖼️ Derivatives ready for {filename}: {sorted(derivatives)}")
+
+def schedule_derivatives(filename: str):
+    """Start building derivatives in the background unless already underway"""
+    if not derivative_widths() or filename in derivative_tasks:
+        return
+    
+    async def run():
+        try:
+            await build_derivatives(filename)
+        except Exception as e:
+            print(f"⚠️ Derivatives failed for {filename}: {e}")
+        finally:
+            derivative_tasks.pop(filename, None)
+    
+    derivative_tasks[filename] = asyncio.create_task(run())
+
+def requested_variant(filename: str, width: Optional[int], image_format: Optional[str]) -> str:
+    """Name of the stored file that exactly answers an /image request"""
+    wanted = None
+    if image_format in (None, "webp"):
+        wanted = pick_derivative(width)
+        if wanted is None and FULL_WEBP_VARIANT and image_format == "webp":
+            wanted = FULL_SIZE
+    return filename if wanted is None else derivative_filename(filename, wanted)
+
+async def select_image_variant(filename: str, width: Optional[int], image_format: Optional[str]) -> str:
+    """Name of the stored file to serve: the requested variant, or the original until it exists"""
+    storage = get_image_storage()
+    requested = requested_variant(filename, width, image_format)
+    if requested == filename:
+        return filename
+    
+    if requested in hot_images or await storage.exists(requested):
+        return requested
+    if filename in hot_images or await storage.exists(filename):
+        # Older images get their derivatives on first request
+        schedule_derivatives(filename)
+    return filename
+
+def pick_derivative(width: Optional[int]) -> Optional[int]:
+    """Smallest derivative at least as wide as requested; None means the original"""
+    if not width:
+        return None
+    for candidate in DERIVATIVE_WIDTHS:
+        if candidate >= width:
+            return candidate
+    return None
+
+# Pooled client for downloading URL-based results (DALL-E 3 fallback)
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+download_client: Optional[httpx.AsyncClient] = None
+
+def get_download_client() -> httpx.AsyncClient:
+    global download_client
+    if download_client is None:
+        download_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=8),
+            timeout=httpx.Timeout(DOWNLOAD_TIMEOUT, connect=10.0),
+            follow_redirects=True
+        )
+    return download_client
+
+@app.on_event("shutdown")
+async def shutdown_download_client():
+    global download_client
+    if download_client is not None:
+        await download_client.aclose()
+        download_client = None
+
+async def download_generated_image(url: str) -> StoredImage:
+    """Stream a URL result into image storage in chunks.
+
+    Transport errors, 429s and 5xx responses are retried with exponential
+    backoff; anything else fails straight away.
+    """
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            async with get_download_client().stream("GET", url) as response:
+                response.raise_for_status()
+                return await get_image_storage().save_stream(response.aiter_bytes(DOWNLOAD_CHUNK_SIZE))
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = isinstance(e, httpx.TransportError) or (
+                e.response.status_code == 429 or e.response.status_code >= 500
+            )
+            if not retryable or attempt == DOWNLOAD_RETRIES:
+                raise HTTPException(status_code=502, detail=f"Error downloading generated image: {str(e)}")
+            print(f"⚠️ Download attempt {attempt} failed ({e}), retrying...")
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+# Result cache for repeated identical generations
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "5000"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+def generation_cache_key(prompt: str, quality: str, size: str,
+                         reference_image: Optional[ReferenceImage], policy: str = "standard") -> str:
+    """Hash the generated prompt, output settings and preprocessed reference image.
+
+    Keying on the prompt rather than the template id means any change to
+    the prompt text invalidates old results.
+    """
+    digest = hashlib.sha256()
+    normalized = {
+        "prompt": prompt,
+        "quality": quality.strip().lower(),
+        "size": size.strip().lower()
+    }
+    if policy != "standard":
+        # A preview may come from a different backend than a print of the same inputs
+        normalized["policy"] = policy
+    digest.update(json.dumps(normalized, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    digest.update(b"\0")
+    if reference_image:
+        digest.update(reference_image.mime_type.encode("ascii"))
+        digest.update(reference_image.data)
+    return digest.hexdigest()
+
+class ResultCache:
+    """In-memory LRU from generation key to a stored image.
+
+    The metadata index (generations.cache_key) is the durable record;
+    this only saves a query for recent keys. Eviction only drops entries;
+    the images themselves stay put because they may belong to an order.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.total_bytes -= entry.get("bytes", 0)
+
+    def discard(self, key: str):
+        """Forget an entry whose image is no longer in storage"""
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total_bytes -= entry.get("bytes", 0)
+
+    def put(self, key: str, stored: StoredImage):
+        self.discard(key)
+        self.entries[key] = {"filename": stored.filename, "location": stored.location,
+                             "bytes": stored.size, "created_at": time.time()}
+        self.total_bytes += stored.size
+        self._evict()
+
+    async def lookup(self, key: str) -> Optional[dict]:
+        """Return the stored result for key if its image still exists"""
+        entry = self.entries.get(key)
+        if entry is None:
+            # Fall back to the metadata index for results older than the LRU window
+            indexed = await get_metadata_index().find_by_cache_key(key)
+            if indexed:
+                entry = {"filename": indexed["filename"], "location": indexed["location"], "bytes": indexed["bytes"]}
+        if entry and await get_image_storage().exists(entry["filename"]):
+            self.put(key, StoredImage(entry["filename"], entry["location"], entry.get("bytes", 0)))
+            self.hits += 1
+            return entry
+        # Image was removed behind our back - forget it
+        self.discard(key)
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+result_cache: Optional[ResultCache] = None
+
+def get_result_cache() -> Optional[ResultCache]:
+    """Return the process-wide result cache, or None when disabled"""
+    global result_cache
+    if not RESULT_CACHE_ENABLED:
+        return None
+    if result_cache is None:
+        result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES)
+    return result_cache
+
+# SQLite metadata index for generated images
+METADATA_DB_PATH = os.getenv("METADATA_DB_PATH", str(Path("generated-images") / ".metadata.db"))
+ACCESS_FLUSH_THRESHOLD = int(os.getenv("ACCESS_FLUSH_THRESHOLD", "1000"))
+
+METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    location TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_accessed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL REFERENCES images(filename),
+    template_id TEXT NOT NULL,
+    style_params TEXT NOT NULL,
+    prompt TEXT,
+    quality TEXT,
+    size TEXT,
+    bytes INTEGER,
+    generation_ms REAL,
+    source_hash TEXT,
+    cache_key TEXT,
+    order_id TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_last_accessed ON images(last_accessed_at);
+CREATE INDEX IF NOT EXISTS idx_generations_filename ON generations(filename);
+CREATE INDEX IF NOT EXISTS idx_generations_template_created ON generations(template_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_generations_created ON generations(created_at);
+CREATE INDEX IF NOT EXISTS idx_generations_cache_key ON generations(cache_key);
+CREATE INDEX IF NOT EXISTS idx_generations_order ON generations(order_id);
+CREATE TABLE IF NOT EXISTS paid_orders (
+    order_id TEXT PRIMARY KEY,
+    paid_at REAL NOT NULL
+);
+"""
+
+class MetadataIndex:
+    """Embedded, indexed record of every saved generation.
+
+    One connection in WAL mode shared behind a lock; callers use the
+    async wrappers so queries run in a worker thread, off the event loop.
+    """
+
+    def __init__(self, db_path: str):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        # Image reads are buffered here and written in one batch by the collector,
+        # or sooner once ACCESS_FLUSH_THRESHOLD names are waiting
+        self.pending_access: Dict[str, float] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA busy_timeout=5000")
+            self.conn.executescript(METADATA_SCHEMA)
+            self.conn.commit()
+
+    def _execute(self, sql: str, params: tuple = (), commit: bool = False) -> List[dict]:
+        with self.lock:
+            rows = [dict(row) for row in self.conn.execute(sql, params).fetchall()]
+            if commit:
+                self.conn.commit()
+            return rows
+
+    async def execute(self, sql: str, params: tuple = (), commit: bool = False) -> List[dict]:
+        return await asyncio.to_thread(self._execute, sql, params, commit)
+
+    def _record_generation(self, stored: StoredImage, record: dict):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO images (filename, location, bytes, created_at, last_accessed_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(filename) DO UPDATE SET last_accessed_at = excluded.last_accessed_at",
+                (stored.filename, stored.location, stored.size, now, now)
+            )
+            self.conn.execute(
+                "INSERT INTO generations (filename, template_id, style_params, prompt, quality, size, bytes, "
+                "generation_ms, source_hash, cache_key, order_id, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (stored.filename, record["template_id"], json.dumps(record["style_params"], sort_keys=True),
+                 record.get("prompt"), record.get("quality"), record.get("size"), stored.size,
+                 record.get("generation_ms"), record.get("source_hash"), record.get("cache_key"),
+                 record.get("order_id"), now)
+            )
+            self.conn.commit()
+
+    async def record_generation(self, stored: StoredImage, record: dict):
+        await asyncio.to_thread(self._record_generation, stored, record)
+
+    async def find_by_cache_key(self, cache_key: str) -> Optional[dict]:
+        rows = await self.execute(
+            "SELECT g.filename, i.location, i.bytes FROM generations g JOIN images i ON i.filename = g.filename "
+            "WHERE g.cache_key = ? ORDER BY g.created_at DESC LIMIT 1",
+            (cache_key,)
+        )
+        return rows[0] if rows else None
+
+    async def history(self, template_id: Optional[str] = None, order_id: Optional[str] = None,
+                      before: Optional[float] = None, limit: int = 50) -> List[dict]:
+        clauses, params = [], []
+        if template_id:
+            clauses.append("template_id = ?")
+            params.append(template_id)
+        if order_id:
+            clauses.append("order_id = ?")
+            params.append(order_id)
+        if before:
+            clauses.append("created_at < ?")
+            params.append(before)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = await self.execute(
+            f"SELECT filename, template_id, style_params, prompt, quality, size, bytes, generation_ms, "
+            f"source_hash, order_id, created_at FROM generations {where} ORDER BY created_at DESC LIMIT ?",
+            tuple(params) + (limit,)
+        )
+        for row in rows:
+            row["style_params"] = json.loads(row["style_params"])
+        return rows
+
+    async def stats(self) -> dict:
+        per_template = await self.execute(
+            "SELECT template_id, COUNT(*) AS generations, SUM(bytes) AS bytes, "
+            "AVG(generation_ms) AS avg_generation_ms FROM generations GROUP BY template_id"
+        )
+        totals = await self.execute("SELECT COUNT(*) AS images, COALESCE(SUM(bytes), 0) AS bytes FROM images")
+        return {"images": totals[0]["images"], "bytes": totals[0]["bytes"], "templates": per_template}
+
+    def note_access(self, filename: str):
+        self.pending_access[filename] = time.time()
+        if len(self.pending_access) >= ACCESS_FLUSH_THRESHOLD and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self.flush_access())
+
+    async def flush_access(self):
+        """Write buffered last-access times in a single transaction"""
+        if not self.pending_access:
+            return
+        pending, self.pending_access = self.pending_access, {}
+        await asyncio.to_thread(self._flush_access, list(pending.items()))
+
+    def _flush_access(self, items: List[tuple]):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE images SET last_accessed_at = MAX(last_accessed_at, ?) WHERE filename = ?",
+                [(accessed_at, filename) for filename, accessed_at in items]
+            )
+            self.conn.commit()
+
+    async def mark_order_paid(self, order_id: str):
+        await self.execute(
+            "INSERT INTO paid_orders (order_id, paid_at) VALUES (?, ?) ON CONFLICT(order_id) DO NOTHING",
+            (order_id, time.time()), commit=True
+        )
+
+    async def eviction_candidates(self, accessed_before: Optional[float], limit: int,
+                                  exclude: Optional[set] = None) -> List[dict]:
+        """Least recently accessed images not attached to a paid order"""
+        clauses, params = "", []
+        if accessed_before is not None:
+            clauses += " AND i.last_accessed_at < ?"
+            params.append(accessed_before)
+        if exclude:
+            clauses += f" AND i.filename NOT IN ({', '.join('?' * len(exclude))})"
+            params.extend(exclude)
+        return await self.execute(
+            "SELECT i.filename, i.bytes FROM images i "
+            "WHERE NOT EXISTS (SELECT 1 FROM generations g JOIN paid_orders p ON p.order_id = g.order_id "
+            f"WHERE g.filename = i.filename){clauses} ORDER BY i.last_accessed_at LIMIT ?",
+            tuple(params) + (limit,)
+        )
+
+    async def total_bytes(self) -> int:
+        rows = await self.execute("SELECT COALESCE(SUM(bytes), 0) AS bytes FROM images")
+        return rows[0]["bytes"]
+
+    async def forget_images(self, filenames: List[str]):
+        """Drop evicted images; generation rows stay as history"""
+        await asyncio.to_thread(self._forget_images, filenames)
+
+    def _forget_images(self, filenames: List[str]):
+        with self.lock:
+            self.conn.executemany("DELETE FROM images WHERE filename = ?", [(f,) for f in filenames])
+            self.conn.commit()
+
+    async def import_legacy_images(self, images: List[tuple]):
+        """Index pre-existing files as (filename, location, bytes, atime) so they can be collected"""
+        await asyncio.to_thread(self._import_legacy_images, images)
+
+    def _import_legacy_images(self, images: List[tuple]):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO images (filename, location, bytes, created_at, last_accessed_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(filename) DO NOTHING",
+                [(name, location, size, atime, atime) for name, location, size, atime in images]
+            )
+            self.conn.commit()
+
+    async def add_bytes(self, filename: str, size: int):
+        """Account derivative files against their source image"""
+        await self.execute("UPDATE images SET bytes = bytes + ? WHERE filename = ?", (size, filename), commit=True)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+metadata_index: Optional[MetadataIndex] = None
+
+def get_metadata_index() -> MetadataIndex:
+    global metadata_index
+    if metadata_index is None:
+        metadata_index = MetadataIndex(METADATA_DB_PATH)
+    return metadata_index
+
+@app.on_event("shutdown")
+async def shutdown_metadata_index():
+    global metadata_index
+    if metadata_index is not None:
+        metadata_index.close()
+        metadata_index = None
+
+# Retention and disk-quota garbage collector for generated images
+# Opt-in: paid orders are only protected once clients link generations to an order_id
+# and call POST /orders/{id}/paid at checkout; the shipped client does not create order ids yet
+GC_ENABLED = os.getenv("GC_ENABLED", "false").lower() == "true"
+GC_MAX_BYTES = int(os.getenv("GC_MAX_BYTES", str(20 * 1024 ** 3)))
+GC_MAX_AGE_DAYS = float(os.getenv("GC_MAX_AGE_DAYS", "30"))
+GC_INTERVAL = float(os.getenv("GC_INTERVAL", "300"))
+GC_BATCH_SIZE = int(os.getenv("GC_BATCH_SIZE", "50"))
+GC_BATCH_PAUSE = float(os.getenv("GC_BATCH_PAUSE", "0.5"))
+# Hours (local time, "start-end") where only quota overruns are collected, e.g. "10-20"
+GC_PEAK_HOURS = os.getenv("GC_PEAK_HOURS", "")
+
+gc_stats = {"runs": 0, "evicted": 0, "evicted_bytes": 0, "last_run_at": None,
+            "last_run_ms": None, "legacy_imported": False, "error": None}
+gc_task: Optional[asyncio.Task] = None
+
+def in_peak_hours() -> bool:
+    if not GC_PEAK_HOURS:
+        return False
+    start, end = (int(part) for part in GC_PEAK_HOURS.split("-"))
+    hour = time.localtime().tm_hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+def scan_legacy_images(base_dir: Path) -> List[tuple]:
+    """Flat top-level images from before content addressing, with their atimes"""
+    images = []
+    with os.scandir(base_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".png") and not entry.name.startswith("."):
+                stat = entry.stat()
+                images.append((entry.name, entry.path, stat.st_size, stat.st_atime or stat.st_mtime))
+    return images
+
+async def evict_batch(candidates: List[dict], failed: Optional[set] = None) -> int:
+    """Delete one batch of images from storage and the index, returning bytes freed.
+
+    Names that could not be deleted are added to failed.
+    """
+    storage = get_image_storage()
+    freed = 0
+    evicted = []
+    for candidate in candidates:
+        try:
+            for width in derivative_widths():
+                hot_images.discard(derivative_filename(candidate["filename"], width))
+                await storage.delete(derivative_filename(candidate["filename"], width))
+            hot_images.discard(candidate["filename"])
+            await storage.delete(candidate["filename"])
+            await asyncio.to_thread(delete_print_exports, candidate["filename"])
+        except Exception as e:
+            print(f"⚠️ GC - Could not delete {candidate['filename']}: {e}")
+            if failed is not None:
+                failed.add(candidate["filename"])
+            continue
+        evicted.append(candidate["filename"])
+        freed += candidate["bytes"]
+    await get_metadata_index().forget_images(evicted)
+    gc_stats["evicted"] += len(evicted)
+    gc_stats["evicted_bytes"] += freed
+    return freed
+
+async def collect_garbage():
+    """One collection pass: expire print exports and old images, then evict LRU until under quota"""
+    index = get_metadata_index()
+    await index.flush_access()
+    
+    if not gc_stats["legacy_imported"] and isinstance(get_image_storage(), LocalImageStorage):
+        await index.import_legacy_images(await asyncio.to_thread(scan_legacy_images, ensure_directories()))
+        gc_stats["legacy_imported"] = True
+    
+    removed, freed = await asyncio.to_thread(expire_print_exports)
+    if removed:
+        print(f"🗑️ GC - Removed {removed} print export(s), {freed / 1024 ** 2:.1f} MB")
+    
+    # Rows whose files could not be deleted are skipped for the rest of this pass
+    failed = set()
+    
+    # Age-based expiry is deferred during peak hours; quota overruns are not
+    if GC_MAX_AGE_DAYS > 0 and not in_peak_hours():
+        cutoff = time.time() - GC_MAX_AGE_DAYS * 86400
+        while True:
+            candidates = await index.eviction_candidates(cutoff, GC_BATCH_SIZE, failed)
+            if not candidates:
+                break
+            failures = len(failed)
+            await evict_batch(candidates, failed)
+            if len(failed) - failures == len(candidates):
+                print(f"⚠️ GC - Nothing in the batch could be deleted, ending this pass")
+                return
+            await asyncio.sleep(GC_BATCH_PAUSE)
+    
+    total = await index.total_bytes()
+    while total > GC_MAX_BYTES:
+        candidates = await index.eviction_candidates(None, GC_BATCH_SIZE, failed)
+        if not candidates:
+            print(f"⚠️ GC - Over quota but every remaining image belongs to a paid order")
+            break
+        failures = len(failed)
+        total -= await evict_batch(candidates, failed)
+        if len(failed) - failures == len(candidates):
+            print(f"⚠️ GC - Nothing in the batch could be deleted, ending this pass")
+            return
+        await asyncio.sleep(GC_BATCH_PAUSE)
+
+async def garbage_collector():
+    """Run collect_garbage every GC_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        started = time.perf_counter()
+        try:
+            await collect_garbage()
+            gc_stats["error"] = None
+        except Exception as e:
+            gc_stats["error"] = str(e)
+            print(f"⚠️ GC - Collection failed: {e}")
+        gc_stats["runs"] += 1
+        gc_stats["last_run_at"] = time.time()
+        gc_stats["last_run_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+@app.on_event("startup")
+async def startup_garbage_collector():
+    global gc_task
+    if GC_ENABLED:
+        gc_task = asyncio.create_task(garbage_collector())
+
+@app.on_event("shutdown")
+async def shutdown_garbage_collector():
+    global gc_task
+    if gc_task is not None:
+        gc_task.cancel()
+        await asyncio.gather(gc_task, return_exceptions=True)
+        gc_task = None
+
 @app.get("/")
 async def root():
     return {"message": "Roni Daddy AI Image Generator API", "status": "active"}
 
+# Background upstream health monitor
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "30"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "10"))
+HEALTH_STALE_AFTER = float(os.getenv("HEALTH_STALE_AFTER", str(HEALTH_PROBE_INTERVAL * 3)))
+HEALTH_PROBE_WINDOW = 20
+
+upstream_health = {
+    "status": "unknown",
+    "models_available": 0,
+    "error": None,
+    "last_probe_at": None,
+    "last_success_at": None,
+    "last_latency_ms": None,
+    "recent_probes": deque(maxlen=HEALTH_PROBE_WINDOW)
+}
+health_monitor_task: Optional[asyncio.Task] = None
+
+def api_key_problem() -> Optional[str]:
+    """Describe what is wrong with the configured API key, or None if it looks usable"""
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return "OpenAI API key not found in environment variables"
+    if api_key == "your-api-key-here" or api_key == "sk-your-actual-key-here":
+        return "Please replace the placeholder API key with your actual OpenAI API key"
+    if not api_key.startswith('sk-'):
+        return "Invalid API key format - should start with 'sk-'"
+    return None
+
+async def probe_upstream_health():
+    """List models once and record the outcome in upstream_health"""
+    started = time.perf_counter()
+    try:
+        client = get_openai_client()
+        models = await asyncio.wait_for(client.models.list(), timeout=HEALTH_PROBE_TIMEOUT)
+        upstream_health["status"] = "healthy"
+        upstream_health["models_available"] = len(models.data) if models.data else 0
+        upstream_health["error"] = None
+        upstream_health["last_success_at"] = time.time()
+        upstream_health["recent_probes"].append(True)
+    except Exception as e:
+        upstream_health["status"] = "unhealthy"
+        upstream_health["error"] = str(e) or type(e).__name__
+        upstream_health["recent_probes"].append(False)
+    finally:
+        upstream_health["last_latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        upstream_health["last_probe_at"] = time.time()
+
+async def health_monitor():
+    """Probe upstream every HEALTH_PROBE_INTERVAL seconds"""
+    while True:
+        if api_key_problem() is None:
+            await probe_upstream_health()
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+
+@app.on_event("startup")
+async def startup_health_monitor():
+    global health_monitor_task
+    health_monitor_task = asyncio.create_task(health_monitor())
+
+@app.on_event("shutdown")
+async def shutdown_health_monitor():
+    global health_monitor_task
+    if health_monitor_task is not None:
+        health_monitor_task.cancel()
+        await asyncio.gather(health_monitor_task, return_exceptions=True)
+        health_monitor_task = None
+
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
+    """Health check endpoint, served from the background monitor's last probe"""
+    key_problem = api_key_problem()
+    if key_problem:
+        return {"status": "unhealthy", "error": key_problem}
+    
+    # Only probe inline if the monitor hasn't completed its first probe yet
+    if upstream_health["last_probe_at"] is None:
+        await probe_upstream_health()
+    
+    api_key = os.getenv('OPENAI_API_KEY')
+    probes = upstream_health["recent_probes"]
+    age = time.time() - upstream_health["last_probe_at"]
+    stale = age > HEALTH_STALE_AFTER
+    body = {
+        "status": upstream_health["status"],
+        "openai": "connected" if upstream_health["status"] == "healthy" else "unreachable",
+        "api_key_preview": f"{api_key[:10]}...{api_key[-4:]}",
+        "models_available": upstream_health["models_available"],
+        "probe": {
+            "age_seconds": round(age, 1),
+            "stale": stale,
+            "last_latency_ms": upstream_health["last_latency_ms"],
+            "last_success_at": upstream_health["last_success_at"],
+            "error_rate": round(probes.count(False) / len(probes), 2) if probes else 0.0,
+            "window": len(probes)
+        },
+        "result_cache": result_cache.stats() if result_cache else None,
+        "preprocessing": preprocess_stats_summary(),
+        "gc": gc_stats if GC_ENABLED else None,
+        "hot_images": hot_images.stats(),
+        "rate_limiter": upstream_limiter.summary(),
+        "circuit_breakers": {key: breaker.summary() for key, breaker in circuit_breakers.items()},
+        "backends": {name: stats.summary() for name, stats in backend_stats.items()},
+        "admission": admission.summary(),
+        "mockups": mockup_cache.stats()
+    }
+    if stale and body["status"] == "healthy":
+        body["status"] = "degraded"
+    if upstream_health["error"]:
+        body["error"] = upstream_health["error"]
+        body["suggestion"] = "Check your OpenAI API key in the .env file"
+    return body
+
+# Generations currently waiting on upstream, keyed like the result cache
+inflight_generations: Dict[str, asyncio.Task] = {}
+
+async def generate_and_save(template_id: str, prompt: str, reference_image: Optional[ReferenceImage],
+                            quality: str, size: str, policy: str = "standard") -> tuple:
+    """Call upstream once and persist the result; returns (StoredImage, backend used)"""
+    # Generate image on the backend the routing policy picks
+    print(f"🔄 API - Starting AI generation ({policy})...")
+    response, backend = await route_image_generation(
+        prompt=prompt,
+        reference_image=reference_image,
+        quality=quality,
+        size=size,
+        policy_name=policy
+    )
+    print(f"🔄 API - AI generation completed on {backend}")
+    
+    if not response or not response.data:
+        raise HTTPException(status_code=500, detail="No image generated")
+    
+    # Extract and save image (handle both URL and base64 responses)
+    if hasattr(response.data[0], 'b64_json') and response.data[0].b64_json:
+        # Base64 response (GPT-image-1 style)
+        stored = await save_generated_image(response.data[0].b64_json)
+    elif hasattr(response.data[0], 'url') and response.data[0].url:
+        # URL response (DALL-E 3 style) - download and save
+        stored = await download_generated_image(response.data[0].url)
+    else:
+        raise HTTPException(status_code=500, detail="Invalid response format - no image data")
+    
+    if stored.deduplicated:
+        print(f"♻️ API - Identical image already stored as {stored.filename}")
+    return stored, backend
+
+async def index_generation(stored: StoredImage, result: dict, quality: str, size: str,
+                           reference_image: Optional[ReferenceImage], cache_key: Optional[str],
+                           order_id: Optional[str], generation_ms: Optional[float] = None):
+    """Write a generation to the metadata index without ever failing the request"""
     try:
-        # Check if API key exists
-        api_key = os.getenv('OPENAI_API_KEY')
-        if not api_key:
-            return {"status": "unhealthy", "error": "OpenAI API key not found in environment variables"}
-        
-        if api_key == "your-api-key-here" or api_key == "sk-your-actual-key-here":
-            return {"status": "unhealthy", "error": "Please replace the placeholder API key with your actual OpenAI API key"}
-        
-        # Check API key format
-        if not api_key.startswith('sk-'):
-            return {"status": "unhealthy", "error": "Invalid API key format - should start with 'sk-'"}
-        
-        # Test connection to OpenAI
-        client = get_openai_client()
-        models = client.models.list()
+        await get_metadata_index().record_generation(stored, {
+            **result,
+            "quality": quality,
+            "size": size,
+            "generation_ms": generation_ms,
+            "source_hash": hashlib.sha256(reference_image.data).hexdigest() if reference_image else None,
+            "cache_key": cache_key,
+            "order_id": order_id
+        })
+    except sqlite3.Error as e:
+        # The image is saved; a missing index row must not fail the order
+        print(f"⚠️ API - Failed to index {stored.filename}: {e}")
+
+async def run_generation(template_id: str, style_data: dict, reference_image: Optional[ReferenceImage],
+                         quality: str, size: str, order_id: Optional[str] = None,
+                         purpose: Optional[str] = None) -> dict:
+    """Run one generation end to end and return the /generate response body"""
+    policy = routing_policy_for(template_id, purpose)
+    
+    # Generate appropriate prompt
+    prompt = generate_style_prompt(template_id, style_data)
+    print(f"🔄 API - Generated prompt: {prompt}")
+    
+    result = {
+        "success": True,
+        "prompt": prompt,
+        "template_id": template_id,
+        "style_params": style_data
+    }
+    
+    # Serve repeats of an identical request from the result cache
+    cache = get_result_cache()
+    cache_key = generation_cache_key(prompt, quality, size, reference_image, policy)
+    cached = await cache.lookup(cache_key) if cache else None
+    if cached:
+        print(f"⚡ API - Result cache hit: {cached['filename']}")
+        if order_id:
+            # Link the reused image to this order too
+            await index_generation(
+                StoredImage(cached["filename"], cached["location"], cached.get("bytes", 0)),
+                result, quality, size, reference_image, cache_key, order_id
+            )
+        return {**result, "filename": cached["filename"], "file_path": cached["location"], "cached": True}
+    
+    # Attach to an identical generation that is already in flight
+    shared = inflight_generations.get(cache_key)
+    if shared is not None:
+        print(f"🔗 API - Joining in-flight identical generation")
+        stored, _, backend, result_key = await asyncio.shield(shared)
+        if order_id:
+            await index_generation(stored, result, quality, size, reference_image, result_key, order_id)
+        return {**result, "filename": stored.filename, "file_path": stored.location,
+                "backend": backend, "coalesced": True}
+    
+    async def generate_shared():
+        started = time.perf_counter()
+        stored, backend = await generate_and_save(template_id, prompt, reference_image, quality, size, policy)
+        generation_ms = round((time.perf_counter() - started) * 1000, 1)
+        schedule_derivatives(stored.filename)
+        # A fallback answer stands in for this request only; caching it would keep serving it after recovery
+        routing = ROUTING_POLICIES[policy]
+        result_key = cache_key if routing.fastest or backend == routing.backends[0] else None
+        if cache and result_key:
+            cache.put(cache_key, stored)
+        await index_generation(stored, result, quality, size, reference_image, result_key, order_id, generation_ms)
+        return stored, generation_ms, backend, result_key
+    
+    def generation_done(task: asyncio.Task):
+        inflight_generations.pop(cache_key, None)
+        if not task.cancelled():
+            # Mark retrieved so a generation every caller abandoned doesn't log a warning
+            task.exception()
+    
+    # The generation runs in its own task so a caller going away doesn't fail the others
+    shared = asyncio.create_task(generate_shared())
+    inflight_generations[cache_key] = shared
+    shared.add_done_callback(generation_done)
+    stored, generation_ms, backend, _ = await asyncio.shield(shared)
         
-        return {
-            "status": "healthy", 
-            "openai": "connected",
-            "api_key_preview": f"{api_key[:10]}...{api_key[-4:]}",
-            "models_available": len(models.data) if models.data else 0
+    return {**result, "filename": stored.filename, "file_path": stored.location,
+            "backend": backend, "generation_ms": generation_ms}
+
+# Background generation jobs
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "8"))
+GENERATION_QUEUE_SIZE = int(os.getenv("GENERATION_QUEUE_SIZE", "500"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+
+generation_queue: Optional[asyncio.Queue] = None
+generation_workers: List[asyncio.Task] = []
+jobs: Dict[str, dict] = {}
+
+def prune_jobs():
+    """Forget finished jobs older than JOB_TTL_SECONDS"""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    expired = [job_id for job_id, job in jobs.items()
+               if job.get("finished_at") and job["finished_at"] < cutoff]
+    for job_id in expired:
+        del jobs[job_id]
+
+def submit_generation_job(params: dict) -> dict:
+    """Queue a generation for the worker pool and return its job record"""
+    if generation_queue is None:
+        raise HTTPException(status_code=503, detail="Generation workers not running")
+    prune_jobs()
+    
+    job_id = uuid.uuid4().hex
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "template_id": params["template_id"],
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "error": None
+    }
+    try:
+        generation_queue.put_nowait((job_id, params))
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Generation queue is full, try again shortly",
+                            headers={"Retry-After": str(admission.retry_after(admission.load()))})
+    jobs[job_id] = job
+    return job
+
+async def generation_worker(worker_id: int):
+    """Pull queued jobs and run them one at a time"""
+    while True:
+        job_id, params = await generation_queue.get()
+        job = jobs.get(job_id)
+        try:
+            if job is None:
+                continue
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            print(f"⚙️ Worker {worker_id} - running job {job_id}")
+            async with admission.slot():
+                job["result"] = await run_generation(**params)
+            job["status"] = "completed"
+        except HTTPException as e:
+            job["status"] = "failed"
+            job["error"] = e.detail
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            if job is not None:
+                job["finished_at"] = time.time()
+            generation_queue.task_done()
+
+@app.on_event("startup")
+async def startup_generation_workers():
+    """Start the bounded pool of generation workers"""
+    global generation_queue
+    generation_queue = asyncio.Queue(maxsize=GENERATION_QUEUE_SIZE)
+    for worker_id in range(GENERATION_WORKERS):
+        generation_workers.append(asyncio.create_task(generation_worker(worker_id)))
+    print(f"⚙️ Started {GENERATION_WORKERS} generation workers (queue size {GENERATION_QUEUE_SIZE})")
+
+@app.on_event("shutdown")
+async def shutdown_generation_workers():
+    """Stop the generation workers"""
+    for task in generation_workers:
+        task.cancel()
+    await asyncio.gather(*generation_workers, return_exceptions=True)
+    generation_workers.clear()
+
+# Admission control: refuse work early instead of letting every request slow down
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "100"))
+ADMISSION_MAX_UPSTREAM = int(os.getenv("ADMISSION_MAX_UPSTREAM", "48"))
+ADMISSION_MAX_RSS_MB = int(os.getenv("ADMISSION_MAX_RSS_MB", "0"))  # 0 disables the memory check
+# Past this fraction of any limit, text-only previews are generated at quality="low"
+ADMISSION_DEGRADE_AT = float(os.getenv("ADMISSION_DEGRADE_AT", "0.75"))
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", "120"))
+
+def process_rss_bytes() -> Optional[int]:
+    """Resident memory of this process, where /proc is available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class AdmissionController:
+    """Admit generation requests while queue depth, upstream load and memory allow.
+
+    Load is measured as a fraction of each limit; at 1.0 requests are shed
+    with a Retry-After estimated from how long the excess takes to drain.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        # Smoothed duration of an admitted request, seeded with a typical gpt-image-1 call
+        self.avg_seconds = 30.0
+        self.stats = {"admitted": 0, "shed": 0, "degraded": 0}
+
+    def load(self) -> Dict[str, float]:
+        queue_depth = generation_queue.qsize() if generation_queue else 0
+        load = {
+            "in_flight": self.in_flight / ADMISSION_MAX_IN_FLIGHT,
+            "queue": queue_depth / ADMISSION_MAX_QUEUE_DEPTH,
+            "upstream": (upstream_limiter.in_flight + upstream_limiter.waiting) / ADMISSION_MAX_UPSTREAM
         }
-    except Exception as e:
+        rss = process_rss_bytes() if ADMISSION_MAX_RSS_MB else None
+        if rss is not None:
+            load["memory"] = rss / (ADMISSION_MAX_RSS_MB * 1024 ** 2)
+        return load
+
+    def retry_after(self, load: Dict[str, float]) -> int:
+        """Seconds until enough admitted work has finished to make room"""
+        waits = [1.0]
+        if load["in_flight"] >= 1:
+            excess = self.in_flight - ADMISSION_MAX_IN_FLIGHT + 1
+            waits.append(excess * self.avg_seconds / ADMISSION_MAX_IN_FLIGHT)
+        if load["queue"] >= 1:
+            excess = generation_queue.qsize() - ADMISSION_MAX_QUEUE_DEPTH + 1
+            waits.append(excess * self.avg_seconds / max(1, GENERATION_WORKERS))
+        if load["upstream"] >= 1:
+            excess = upstream_limiter.in_flight + upstream_limiter.waiting - ADMISSION_MAX_UPSTREAM + 1
+            waits.append(max(upstream_limiter.retry_after(), excess * self.avg_seconds / ADMISSION_MAX_UPSTREAM))
+        if load.get("memory", 0) >= 1:
+            waits.append(self.avg_seconds)
+        # Spread retries out so shed clients don't all come back at once
+        return min(ADMISSION_MAX_RETRY_AFTER, math.ceil(max(waits) * random.uniform(1.0, 1.25)))
+
+    def admit(self) -> float:
+        """Raise 503 if the server is saturated; otherwise return the current pressure (0-1)"""
+        load = self.load()
+        pressure = max(load.values())
+        if pressure >= 1:
+            self.stats["shed"] += 1
+            retry_after = self.retry_after(load)
+            saturated = ", ".join(name for name, value in load.items() if value >= 1)
+            print(f"🚦 API - Shedding request ({saturated} saturated), retry after {retry_after}s")
+            raise HTTPException(status_code=503, detail="Server is busy, try again shortly",
+                                headers={"Retry-After": str(retry_after)})
+        self.stats["admitted"] += 1
+        return pressure
+
+    @asynccontextmanager
+    async def slot(self, observe: bool = True):
+        """Count a request as in flight and learn how long generations take"""
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if observe:
+                self.observe(time.perf_counter() - started)
+
+    def observe(self, seconds: float):
+        self.avg_seconds += 0.2 * (seconds - self.avg_seconds)
+
+    def summary(self) -> dict:
         return {
-            "status": "unhealthy", 
-            "error": str(e),
-            "suggestion": "Check your OpenAI API key in the .env file"
+            "in_flight": self.in_flight,
+            "load": {name: round(value, 2) for name, value in self.load().items()},
+            "avg_request_s": round(self.avg_seconds, 1),
+            **self.stats
         }
 
+admission = AdmissionController()
+
 @app.post("/generate")
 async def generate_image(
     template_id: str = Form(...),
     style_params: str = Form(...),  # JSON string
     image: Optional[UploadFile] = File(None),
     quality: str = Form("medium"),
-    size: str = Form("1024x1024")
+    size: str = Form("1024x1024"),
+    async_job: bool = Form(False),
+    order_id: Optional[str] = Form(None),
+    purpose: Optional[str] = Form(None)  # "preview", "print" or "standard"
 ):
-    """Generate AI image based on template and style parameters"""
+    """Generate AI image based on template and style parameters.
+
+    With async_job=true the request is queued and a job id is returned
+    immediately; poll /jobs/{job_id} for the result. purpose selects the
+    routing policy (previews may use the fastest backend, prints always
+    use gpt-image-1).
+    """
+    
+    # Shed load before any upload is decoded
+    pressure = admission.admit()
     
     try:
         print(f"🔄 API - Generate request received")
@@ -352,78 +2412,1060 @@ async def generate_image(
         style_data = json.loads(style_params)
         print(f"🔄 API - style_data: {style_data}")
         
-        # Convert uploaded image if provided
-        reference_image = None
-        if image:
-            print(f"🔄 API - Converting uploaded image...")
-            reference_image = convert_image_for_api(image.file)
-            print(f"🔄 API - Image converted successfully")
-        
-        # Generate appropriate prompt
-        prompt = generate_style_prompt(template_id, style_data)
-        print(f"🔄 API - Generated prompt: {prompt}")
-        
-        # Generate image with DALL-E
-        print(f"🔄 API - Starting AI generation...")
-        response = await generate_image_gpt_image_1(
-            prompt=prompt,
-            reference_image=reference_image,
-            quality=quality,
-            size=size
-        )
-        print(f"🔄 API - AI generation completed")
+        # Reject an unknown purpose before any upload is preprocessed or a job is queued
+        policy = routing_policy_for(template_id, purpose)
         
-        if not response or not response.data:
-            raise HTTPException(status_code=500, detail="No image generated")
+        # Near capacity, text-only previews trade quality for a faster, cheaper call. The edit
+        # endpoint used for uploads takes no quality setting, so those are never degraded.
+        degraded = (image is None and policy == "preview"
+                    and quality != "low" and pressure >= ADMISSION_DEGRADE_AT)
+        if degraded:
+            quality = "low"
+            admission.stats["degraded"] += 1
+            print(f"🚦 API - Under load ({pressure:.0%}), preview degraded to quality=low")
         
-        # Extract and save image (handle both URL and base64 responses)
-        if hasattr(response.data[0], 'b64_json') and response.data[0].b64_json:
-            # Base64 response (GPT-image-1 style)
-            file_path, filename = save_generated_image(response.data[0].b64_json, template_id)
-        elif hasattr(response.data[0], 'url') and response.data[0].url:
-            # URL response (DALL-E 3 style) - download and save
-            import requests
-            img_response = requests.get(response.data[0].url)
-            img_response.raise_for_status()
-            
-            timestamp = int(time.time())
-            random_id = str(uuid.uuid4())[:8]
-            filename = f"{template_id}-{timestamp}-{random_id}.png"
+        # Queued jobs are timed by the worker that runs them
+        async with admission.slot(observe=not async_job):
+            # Convert uploaded image if provided
+            reference_image = None
+            preprocess_ms = None
+            if image:
+                print(f"🔄 API - Converting uploaded image...")
+                reference_image, preprocess_ms = await preprocess_reference_image(
+                    await image.read(), encoding_profile_for(template_id)
+                )
+                print(f"🔄 API - Image converted successfully in {preprocess_ms:.0f}ms")
             
-            generated_dir = ensure_directories()
-            file_path = generated_dir / filename
+            params = {
+                "template_id": template_id,
+                "style_data": style_data,
+                "reference_image": reference_image,
+                "quality": quality,
+                "size": size,
+                "order_id": order_id,
+                "purpose": purpose
+            }
             
-            with open(file_path, 'wb') as f:
-                f.write(img_response.content)
-                
-            file_path = str(file_path)
-        else:
-            raise HTTPException(status_code=500, detail="Invalid response format - no image data")
+            if async_job:
+                job = submit_generation_job(params)
+                print(f"🔄 API - Queued job {job['job_id']}")
+                return JSONResponse(status_code=202, content={
+                    "success": True,
+                    "job_id": job["job_id"],
+                    "status": job["status"],
+                    "status_url": f"/jobs/{job['job_id']}",
+                    "preprocess_ms": preprocess_ms,
+                    **({"degraded": True} if degraded else {})
+                })
             
-        return {
-            "success": True,
-            "filename": filename,
-            "file_path": file_path,
-            "prompt": prompt,
-            "template_id": template_id,
-            "style_params": style_data
-        }
+            result = await run_generation(**params)
+        return {**result, "preprocess_ms": preprocess_ms, **({"degraded": True} if degraded else {})}
     
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid style_params JSON")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Bulk orders: many generations in one request, results streamed back as NDJSON
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "6"))
+
+async def run_batch_item(index: int, item: dict, upload: Optional[bytes], order_id: Optional[str],
+                         upload_slots: asyncio.Semaphore, upstream_slots: asyncio.Semaphore) -> dict:
+    """Preprocess and generate one batch item, reporting failures instead of raising"""
+    try:
+        reference_image, preprocess_ms = None, None
+        if upload is not None:
+            # The batch feeds the pool a few uploads at a time and waits its turn behind other
+            # traffic, so it never trips the saturation timeout meant for interactive requests
+            async with upload_slots:
+                reference_image, preprocess_ms = await preprocess_reference_image(
+                    upload, encoding_profile_for(item["template_id"]), wait_timeout=None
+                )
+        async with upstream_slots, admission.slot():
+            result = await run_generation(item["template_id"], item["style_params"], reference_image,
+                                          item["quality"], item["size"], order_id, item["purpose"])
+        return {"index": index, **result, "preprocess_ms": preprocess_ms}
+    except HTTPException as e:
+        return {"index": index, "success": False, "status_code": e.status_code, "error": e.detail}
+    except Exception as e:
+        return {"index": index, "success": False, "status_code": 500, "error": str(e)}
+
+@app.post("/generate/batch")
+async def generate_batch(
+    items: str = Form(...),  # JSON list
+    images: List[UploadFile] = File(None),
+    quality: str = Form("medium"),
+    size: str = Form("1024x1024"),
+    order_id: Optional[str] = Form(None),
+    purpose: Optional[str] = Form(None)
+):
+    """Generate many images in one request.
+
+    items is a JSON list of {template_id, style_params, image, quality, size, purpose},
+    where image is the index of that item's file in `images` (or null) and
+    quality/size/purpose default to the form fields. At most PREPROCESS_WORKERS
+    uploads are preprocessed and BATCH_CONCURRENCY items call upstream at once.
+    The response is NDJSON: one line per item as it finishes (with its
+    index), then a summary line.
+    """
+    admission.admit()
+    try:
+        batch = json.loads(items)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid items JSON")
+    if not isinstance(batch, list) or not batch:
+        raise HTTPException(status_code=400, detail="items must be a non-empty list")
+    if len(batch) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    
+    images = images or []
+    normalized = []
+    for index, item in enumerate(batch):
+        if not isinstance(item, dict) or not item.get("template_id"):
+            raise HTTPException(status_code=400, detail=f"Item {index} needs a template_id")
+        image_index = item.get("image")
+        if image_index is not None and not (isinstance(image_index, int) and 0 <= image_index < len(images)):
+            raise HTTPException(status_code=400, detail=f"Item {index} refers to missing image {image_index}")
+        normalized.append({
+            "template_id": item["template_id"],
+            "style_params": item.get("style_params") or {},
+            "image": image_index,
+            "quality": item.get("quality", quality),
+            "size": item.get("size", size),
+            "purpose": item.get("purpose", purpose)
+        })
+        routing_policy_for(item["template_id"], normalized[-1]["purpose"])
+    
+    # Read every upload now; the form is closed once this handler returns
+    uploads = [await image.read() for image in images]
+    print(f"📦 API - Batch of {len(normalized)} items, {len(uploads)} uploads")
+    
+    async def stream():
+        started = time.perf_counter()
+        upload_slots = asyncio.Semaphore(max(1, min(PREPROCESS_WORKERS, PREPROCESS_MAX_PENDING)))
+        upstream_slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(run_batch_item(
+                index, item, uploads[item["image"]] if item["image"] is not None else None, order_id,
+                upload_slots, upstream_slots
+            ))
+            for index, item in enumerate(normalized)
+        ]
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                outcome = await next_done
+                if outcome.get("success"):
+                    succeeded += 1
+                yield json.dumps(outcome) + "\n"
+        finally:
+            # Client went away: stop items that haven't finished
+            for task in tasks:
+                task.cancel()
+        
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        print(f"📦 API - Batch finished: {succeeded}/{len(tasks)} succeeded in {elapsed_ms}ms")
+        yield json.dumps({"done": True, "items": len(tasks), "succeeded": succeeded,
+                          "failed": len(tasks) - succeeded, "elapsed_ms": elapsed_ms}) + "\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Report the status of a queued generation, with its result once completed"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    body = {
+        "job_id": job_id,
+        "status": job["status"],
+        "template_id": job["template_id"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"]
+    }
+    if job["status"] == "queued":
+        body["queue_depth"] = generation_queue.qsize() if generation_queue else 0
+    elif job["status"] == "completed":
+        body["result"] = job["result"]
+    elif job["status"] == "failed":
+        body["error"] = job["error"]
+    return body
+
+# Generated names never change content, so clients and proxies may keep them forever
+IMAGE_CACHE_CONTROL = os.getenv("IMAGE_CACHE_CONTROL", "public, max-age=31536000, immutable")
+# Sent when the original stands in for a preview that isn't rendered yet
+IMAGE_FALLBACK_CACHE_CONTROL = os.getenv("IMAGE_FALLBACK_CACHE_CONTROL", "no-cache")
+
+legacy_etags: "OrderedDict[tuple, str]" = OrderedDict()
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+async def image_etag(filename: str, file_path: Optional[Path], data: Optional[bytes]) -> str:
+    """Strong ETag from content: content-addressed names already carry it, legacy files are hashed once"""
+    if CONTENT_FILENAME_RE.match(filename):
+        return f'"{filename.rsplit(".", 1)[0]}"'
+    if data is not None:
+        return f'"{hashlib.sha256(data).hexdigest()}"'
+    
+    stat = file_path.stat()
+    memo_key = (filename, stat.st_mtime_ns, stat.st_size)
+    etag = legacy_etags.get(memo_key)
+    if etag is None:
+        etag = f'"{await asyncio.to_thread(hash_file, file_path)}"'
+        legacy_etags[memo_key] = etag
+        if len(legacy_etags) > 10000:
+            legacy_etags.popitem(last=False)
+    return etag
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison (weak comparison, as RFC 9110 requires for it)"""
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or etag in [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+
+def parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    """Parse a single "bytes=" range into inclusive (start, end).
+
+    Returns None for headers we don't serve partially (multiple or malformed
+    ranges), which means the full body; raises ValueError if unsatisfiable.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, _, end_text = spec.strip().partition("-")
+    if not (start_text.isdigit() or start_text == "") or not (end_text.isdigit() or end_text == ""):
+        return None
+    
+    if not start_text:
+        # Suffix range: the last N bytes
+        if not end_text or int(end_text) == 0:
+            raise ValueError("range not satisfiable")
+        return max(0, size - int(end_text)), size - 1
+    
+    start = int(start_text)
+    end = int(end_text) if end_text else size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, min(end, size - 1)
+
+async def read_range(file_path: Path, start: int, end: int) -> bytes:
+    async with aiofiles.open(file_path, "rb") as f:
+        await f.seek(start)
+        return await f.read(end - start + 1)
+
+# Hand cold files to the reverse proxy instead of streaming them through Python:
+#   x-accel    -> X-Accel-Redirect: IMAGE_ACCEL_PREFIX + path under generated-images/ (nginx internal location)
+#   x-sendfile -> X-Sendfile: absolute path (Apache mod_xsendfile, lighttpd)
+IMAGE_OFFLOAD = os.getenv("IMAGE_OFFLOAD", "").lower()
+IMAGE_ACCEL_PREFIX = os.getenv("IMAGE_ACCEL_PREFIX", "/protected-images/")
+
+def offload_response(file_path: Path, storage, media_type: str, headers: dict) -> Response:
+    if IMAGE_OFFLOAD == "x-sendfile":
+        headers["X-Sendfile"] = str(file_path.resolve())
+    else:
+        relative = file_path.relative_to(storage.base_dir).as_posix()
+        headers["X-Accel-Redirect"] = IMAGE_ACCEL_PREFIX.rstrip("/") + "/" + quote(relative)
+    return Response(media_type=media_type, headers=headers)
+
 @app.get("/image/{filename}")
-async def get_image(filename: str):
-    """Serve generated image"""
-    generated_dir = ensure_directories()
-    file_path = generated_dir / filename
+async def get_image(request: Request, filename: str, w: Optional[int] = None, format: Optional[str] = None):
+    """Serve generated image (content-addressed or legacy flat name).
+
+    ?w=<pixels> serves the smallest WebP preview at least that wide and
+    ?format=webp the full-size WebP (when FULL_WEBP_VARIANT is on); without
+    either the original is served. While a variant is still being rendered
+    the original stands in, sent with IMAGE_FALLBACK_CACHE_CONTROL so the
+    client picks up the variant later. Responses carry a strong ETag,
+    honour If-None-Match (304) and single byte ranges (206). Recently saved
+    images come from memory; cold files can be offloaded to the proxy.
+    """
+    storage = get_image_storage()
+    storage.local_path(filename)
+    
+    requested = requested_variant(filename, w, format)
+    served = await select_image_variant(filename, w, format)
+    data = hot_images.get(served)
+    file_path = None
+    if data is None:
+        file_path = storage.local_path(served)
+        if file_path is not None:
+            if not file_path.exists():
+                raise HTTPException(status_code=404, detail="Image not found")
+        else:
+            try:
+                data = await storage.read(served)
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail="Image not found")
+    get_metadata_index().note_access(filename)
+    
+    etag = await image_etag(served, file_path, data)
+    headers = {
+        "ETag": etag,
+        # Only the exact variant asked for may be cached under this URL for good
+        "Cache-Control": IMAGE_CACHE_CONTROL if served == requested else IMAGE_FALLBACK_CACHE_CONTROL,
+        "Accept-Ranges": "bytes"
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    media_type = media_type_for(served)
+    if file_path is not None and IMAGE_OFFLOAD:
+        # Cold file: let the reverse proxy send it (it also handles ranges)
+        return offload_response(file_path, storage, media_type, headers)
+    
+    size = file_path.stat().st_size if file_path is not None else len(data)
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            body = await read_range(file_path, start, end) if file_path is not None else data[start:end + 1]
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return Response(content=body, status_code=206, media_type=media_type, headers=headers)
+    
+    if file_path is not None:
+        return FileResponse(file_path, media_type=media_type, headers=headers)
+    return Response(content=data, media_type=media_type, headers=headers)
+
+# Phone-case mockups composited server-side so kiosk tablets receive one small image
+class CaseOutline(NamedTuple):
+    template: str          # overlay PNG (camera cut-out and rim), relative to this file
+    inset: tuple           # printable area as (left, top, right, bottom) fractions of the template
+    corner_radius: float   # printable area corner radius as a fraction of the template width
+
+CASE_OUTLINES = {
+    # Same overlay and .phone-case-content geometry the preview screens use
+    "standard": CaseOutline("public/phone-template.png", (0.03, 0.008, 0.03, 0.008), 0.13),
+    # Film window between the sprocket rails of the film-strip case
+    "film-strip": CaseOutline("public/filmstrip-case.png", (0.27, 0.04, 0.262, 0.04), 0.0),
+}
+
+class PhoneModel(NamedTuple):
+    outline: str           # CASE_OUTLINES entry used for mockups
+    print_size_mm: tuple   # printable back (width, height): the phone body, which the case walls surround
+
+# Keyed by the ids the model screens store: name lower-cased with spaces as dashes
+PHONE_MODELS = {
+    "iphone-16-pro-max": PhoneModel("standard", (77.6, 163.0)),
+    "iphone-16-pro": PhoneModel("standard", (71.5, 149.6)),
+    "iphone-16-plus": PhoneModel("standard", (77.8, 160.9)),
+    "iphone-16": PhoneModel("standard", (71.6, 147.6)),
+    "iphone-15-pro-max": PhoneModel("standard", (76.7, 159.9)),
+    "iphone-15-pro": PhoneModel("standard", (70.6, 146.6)),
+    "iphone-15-plus": PhoneModel("standard", (77.8, 160.9)),
+    "iphone-15": PhoneModel("standard", (71.6, 147.6)),
+    "iphone-14-pro-max": PhoneModel("standard", (77.6, 160.7)),
+    "iphone-14-pro": PhoneModel("standard", (71.5, 147.5)),
+    "iphone-14-plus": PhoneModel("standard", (78.1, 160.8)),
+    "iphone-14": PhoneModel("standard", (71.5, 146.7)),
+    "iphone-13-pro-max": PhoneModel("standard", (78.1, 160.8)),
+    "iphone-13-pro": PhoneModel("standard", (71.5, 146.7)),
+    "iphone-13-mini": PhoneModel("standard", (64.2, 131.5)),
+    "iphone-13": PhoneModel("standard", (71.5, 146.7)),
+    "galaxy-s24-ultra": PhoneModel("standard", (79.0, 162.3)),
+    "galaxy-s24+": PhoneModel("standard", (75.9, 158.5)),
+    "galaxy-s24": PhoneModel("standard", (70.6, 147.0)),
+    "galaxy-s23-ultra": PhoneModel("standard", (78.1, 163.4)),
+    "galaxy-s23+": PhoneModel("standard", (76.2, 157.8)),
+    "galaxy-s23": PhoneModel("standard", (70.9, 146.3)),
+    "galaxy-s22-ultra": PhoneModel("standard", (77.9, 163.3)),
+    "galaxy-s22+": PhoneModel("standard", (75.8, 157.4)),
+    "galaxy-s22": PhoneModel("standard", (70.6, 146.0)),
+    "galaxy-note-20-ultra": PhoneModel("standard", (77.2, 164.8)),
+    "galaxy-note-20": PhoneModel("standard", (75.2, 161.6)),
+    "galaxy-a54-5g": PhoneModel("standard", (76.7, 158.2)),
+    "galaxy-a34-5g": PhoneModel("standard", (78.1, 161.3)),
+    "galaxy-a14-5g": PhoneModel("standard", (78.0, 167.7)),
+    "galaxy-z-fold-5": PhoneModel("standard", (67.1, 154.9)),
+    "galaxy-z-flip-5": PhoneModel("standard", (71.9, 165.1)),
+    "pixel-8-pro": PhoneModel("standard", (76.5, 162.6)),
+    "pixel-8": PhoneModel("standard", (70.8, 150.5)),
+    "pixel-7a": PhoneModel("standard", (72.9, 152.0)),
+    "pixel-7-pro": PhoneModel("standard", (76.6, 162.9)),
+    "pixel-7": PhoneModel("standard", (73.2, 155.6)),
+    "pixel-6a": PhoneModel("standard", (71.8, 152.2)),
+    "pixel-6-pro": PhoneModel("standard", (75.9, 163.9)),
+    "pixel-6": PhoneModel("standard", (74.8, 158.6)),
+    "pixel-5a": PhoneModel("standard", (73.2, 156.2)),
+    "pixel-5": PhoneModel("standard", (70.4, 144.7)),
+    "pixel-4a-5g": PhoneModel("standard", (74.0, 153.9)),
+    "pixel-4a": PhoneModel("standard", (69.4, 144.0)),
+    "pixel-4-xl": PhoneModel("standard", (75.1, 160.4)),
+    "pixel-4": PhoneModel("standard", (68.8, 147.1)),
+}
+
+MOCKUP_WIDTHS = tuple(sorted(int(w) for w in os.getenv("MOCKUP_WIDTHS", "240,360,480,720").split(",") if w))
+MOCKUP_QUALITY = int(os.getenv("MOCKUP_QUALITY", "82"))
+# Encoder effort 0-6; mockups are throwaway previews, so favour speed over a few percent of bytes
+MOCKUP_WEBP_METHOD = int(os.getenv("MOCKUP_WEBP_METHOD", "0"))
+MOCKUP_CACHE_MAX_BYTES = int(os.getenv("MOCKUP_CACHE_MAX_BYTES", str(64 * 1024 ** 2)))
+MOCKUP_CACHE_CONTROL = os.getenv("MOCKUP_CACHE_CONTROL", "public, max-age=86400")
+
+mockup_cache = HotImageCache(MOCKUP_CACHE_MAX_BYTES, HOT_CACHE_MAX_ITEM_BYTES)
+
+class CaseLayers(NamedTuple):
+    """Per-pixel blend terms for one outline at one output width"""
+    box: tuple                      # printable area (left, top, right, bottom) in output pixels
+    overlay_premultiplied: np.ndarray  # template RGB * template alpha, HxWx3 float32
+    overlay_alpha: np.ndarray       # HxW float32
+    design_weight: np.ndarray       # printable mask * (1 - template alpha) inside box, float32
+
+@lru_cache(maxsize=32)
+def case_layers(outline_name: str, width: int) -> CaseLayers:
+    """Load the overlay and rasterise the printable mask once per outline and width"""
+    outline = CASE_OUTLINES[outline_name]
+    with Image.open(Path(__file__).parent / outline.template) as template:
+        template = template.convert("RGBA")
+        height = round(template.height * width / template.width)
+        template = template.resize((width, height), Image.Resampling.LANCZOS)
+    overlay = np.asarray(template, dtype=np.float32) / 255.0
+    overlay_alpha = np.ascontiguousarray(overlay[..., 3])
     
-    if not file_path.exists():
+    left, top, right, bottom = outline.inset
+    box = (round(left * width), round(top * height), width - round(right * width), height - round(bottom * height))
+    # Draw the rounded rectangle at 4x and shrink it for anti-aliased edges
+    supersample = 4
+    mask = Image.new("L", ((box[2] - box[0]) * supersample, (box[3] - box[1]) * supersample), 0)
+    ImageDraw.Draw(mask).rounded_rectangle(
+        (0, 0, mask.width - 1, mask.height - 1), radius=outline.corner_radius * width * supersample, fill=255
+    )
+    mask = mask.resize((box[2] - box[0], box[3] - box[1]), Image.Resampling.BOX)
+    
+    design_weight = (np.asarray(mask, dtype=np.float32) / 255.0) * (1.0 - overlay_alpha[box[1]:box[3], box[0]:box[2]])
+    return CaseLayers(box, overlay[..., :3] * overlay_alpha[..., None], overlay_alpha, design_weight)
+
+def cover_source_width(box: tuple, aspect: float, scale: float) -> int:
+    """Source width at which cover-fitting a source of this aspect (width / height) into box needs no upscaling"""
+    box_width, box_height = box[2] - box[0], box[3] - box[1]
+    return math.ceil(max(box_width, box_height * aspect) * scale)
+
+def place_design(design: Image.Image, size: tuple, x: float, y: float, scale: float,
+                 rows: Optional[tuple] = None, resample=Image.Resampling.BILINEAR) -> Image.Image:
+    """Cover-fit the design into a box of `size`, then translate by x/y percent of the box and scale
+    about its centre, like the preview screens' CSS transform. Uncovered pixels stay transparent.
+
+    rows=(first, last) renders only that band of the box, so large outputs can be built a strip at a time.
+    """
+    box_width, box_height = size
+    first_row, last_row = rows or (0, box_height)
+    factor = max(box_width / design.width, box_height / design.height) * scale
+    # Band origin expressed in design pixels
+    source_left = design.width / 2 - (box_width / 2 + x / 100 * box_width) / factor
+    source_top = design.height / 2 - (box_height / 2 + y / 100 * box_height) / factor + first_row / factor
+    
+    band_height = last_row - first_row
+    crop = (max(0.0, source_left), max(0.0, source_top),
+            min(design.width, source_left + box_width / factor), min(design.height, source_top + band_height / factor))
+    placed = Image.new("RGBA", (box_width, band_height), (0, 0, 0, 0))
+    if crop[2] <= crop[0] or crop[3] <= crop[1]:
+        return placed
+    target = (round((crop[0] - source_left) * factor), round((crop[1] - source_top) * factor))
+    target_size = (max(1, round((crop[2] - crop[0]) * factor)), max(1, round((crop[3] - crop[1]) * factor)))
+    region = design.resize(target_size, resample, box=crop, reducing_gap=2.0)
+    placed.paste(region.convert("RGBA"), target)
+    return placed
+
+def blend_case(design: Image.Image, outline_name: str, width: int, x: float, y: float,
+               scale: float) -> Image.Image:
+    """Blend a design under the case overlay with one vectorised premultiplied "over" """
+    layers = case_layers(outline_name, width)
+    left, top, right, bottom = layers.box
+    placed = place_design(design, (right - left, bottom - top), x, y, scale)
+    placed = np.asarray(placed, dtype=np.float32) / 255.0
+    
+    # The template sits on top of the design, which only shows inside the mask
+    weight = layers.design_weight * placed[..., 3]
+    color = layers.overlay_premultiplied.copy()
+    alpha = layers.overlay_alpha.copy()
+    color[top:bottom, left:right] += placed[..., :3] * weight[..., None]
+    alpha[top:bottom, left:right] += weight
+    np.divide(color, alpha[..., None], out=color, where=alpha[..., None] > 0)
+    
+    pixels = np.dstack((color, alpha))
+    return Image.fromarray(np.clip(pixels * 255.0 + 0.5, 0, 255).astype(np.uint8), "RGBA")
+
+def encode_mockup(mockup: Image.Image, image_format: str) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == "png":
+        mockup.save(buffer, format="PNG", compress_level=1)
+    else:
+        mockup.save(buffer, format="WEBP", quality=MOCKUP_QUALITY, method=MOCKUP_WEBP_METHOD)
+    return buffer.getvalue()
+
+def composite_mockup(image_data: bytes, outline_name: str, width: int, x: float, y: float,
+                     scale: float, image_format: str) -> bytes:
+    """Decode, blend and encode one mockup (runs in a worker thread)"""
+    left, top, right, bottom = case_layers(outline_name, width).box
+    with Image.open(io.BytesIO(image_data)) as design:
+        design.draft("RGB", (right - left, bottom - top))
+        return encode_mockup(blend_case(design, outline_name, width, x, y, scale), image_format)
+
+def mockup_width(requested: Optional[int]) -> int:
+    """Smallest MOCKUP_WIDTHS entry at least as wide as requested (masks exist only at these)"""
+    return next((candidate for candidate in MOCKUP_WIDTHS if candidate >= (requested or 0)), MOCKUP_WIDTHS[-1])
+
+def mockup_cache_key(filename: str, outline_name: str, width: int, x: float, y: float,
+                     scale: float, image_format: str) -> str:
+    return f"{filename}|{outline_name}|{width}|{x:g}|{y:g}|{scale:g}|{image_format}"
+
+@app.on_event("startup")
+async def startup_case_layers():
+    """Rasterise every outline at every mockup width before the first request needs it"""
+    started = time.perf_counter()
+    for outline_name in CASE_OUTLINES:
+        for width in MOCKUP_WIDTHS:
+            await asyncio.to_thread(case_layers, outline_name, width)
+    print(f"📱 Case masks ready: {len(CASE_OUTLINES)} outline(s) x {len(MOCKUP_WIDTHS)} widths "
+          f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+@app.get("/mockup/{filename}")
+async def get_mockup(request: Request, filename: str, model: Optional[str] = None, layout: Optional[str] = None,
+                     w: Optional[int] = None, x: float = 0.0, y: float = 0.0, scale: float = 1.0,
+                     format: str = "webp"):
+    """Generated image composited into a phone-case preview.
+
+    ?model takes the id the model screens store (e.g. iphone-16-pro), or
+    ?layout a collage layout whose case differs (e.g. film-strip-3). ?w is
+    snapped up to the nearest MOCKUP_WIDTHS entry, and x/y/scale mirror the
+    preview transform (percent of the printable area, zoom about its centre).
+    """
+    if layout:
+        if layout not in COLLAGE_LAYOUTS:
+            raise HTTPException(status_code=404, detail=f"Unknown collage layout: {layout}")
+        outline_name = COLLAGE_LAYOUTS[layout].outline
+    elif model:
+        phone = PHONE_MODELS.get(model.lower())
+        if phone is None:
+            raise HTTPException(status_code=404, detail=f"Unknown phone model: {model}")
+        outline_name = phone.outline
+    else:
+        raise HTTPException(status_code=400, detail="model or layout is required")
+    if format not in ("webp", "png"):
+        raise HTTPException(status_code=400, detail="format must be webp or png")
+    if not 0.1 <= scale <= 10:
+        raise HTTPException(status_code=400, detail="scale must be between 0.1 and 10")
+    width = mockup_width(w)
+    
+    storage = get_image_storage()
+    storage.local_path(filename)
+    key = mockup_cache_key(filename, outline_name, width, x, y, scale, format)
+    headers = {
+        "ETag": f'"{hashlib.sha256(key.encode()).hexdigest()[:32]}"',
+        "Cache-Control": MOCKUP_CACHE_CONTROL
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    data = mockup_cache.get(key)
+    if data is None:
+        # A preview derivative big enough to cover the printable area decodes far faster than the original.
+        # The box is tall, so the width needed depends on the source's aspect ratio: start from the
+        # box width and move up to a larger variant once the first one's size is known.
+        box = case_layers(outline_name, width).box
+        source = await select_image_variant(filename, cover_source_width(box, 0.0, scale), None)
+        try:
+            image_data = hot_images.get(source) or await storage.read(source)
+            if source != filename:
+                with Image.open(io.BytesIO(image_data)) as probe:
+                    source_width, aspect = probe.width, probe.width / probe.height
+                needed = cover_source_width(box, aspect, scale)
+                if source_width < needed:
+                    larger = await select_image_variant(filename, needed, None)
+                    if larger != source:
+                        image_data = hot_images.get(larger) or await storage.read(larger)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Image not found")
+        get_metadata_index().note_access(filename)
+        
+        started = time.perf_counter()
+        data = await asyncio.to_thread(composite_mockup, image_data, outline_name, width, x, y, scale, format)
+        mockup_cache.put(key, data)
+        headers["Server-Timing"] = f"composite;dur={(time.perf_counter() - started) * 1000:.1f}"
+    return Response(content=data, media_type=f"image/{format}", headers=headers)
+
+# Multi-image collages rendered once at print resolution, previewed through the mockup compositor
+COLLAGE_PRINT_WIDTH = int(os.getenv("COLLAGE_PRINT_WIDTH", "1200"))
+COLLAGE_MAX_UPLOAD_BYTES = int(os.getenv("COLLAGE_MAX_UPLOAD_BYTES", str(20 * 1024 ** 2)))
+FILM_FRAME_GAP = 0.025
+
+class CollageLayout(NamedTuple):
+    outline: str        # CASE_OUTLINES entry the collage is printed inside
+    slots: tuple        # (left, top, right, bottom) fractions of the printable area, one per image
+    background: tuple   # RGB shown between slots and wherever a zoomed-out image leaves a gap
+
+def film_frames(count: int) -> tuple:
+    """Equal frames stacked down the film window with FILM_FRAME_GAP between them"""
+    height = (1.0 - FILM_FRAME_GAP * (count + 1)) / count
+    tops = [FILM_FRAME_GAP + index * (height + FILM_FRAME_GAP) for index in range(count)]
+    return tuple((0.0, top, 1.0, top + height) for top in tops)
+
+# Template ids from the template selection screen; same slot arrangement as the preview screens
+COLLAGE_LAYOUTS = {
+    "2-in-1": CollageLayout("standard", ((0, 0, 1, 0.5), (0, 0.5, 1, 1)), (255, 255, 255)),
+    "3-in-1": CollageLayout("standard", ((0, 0, 1, 1 / 3), (0, 1 / 3, 1, 2 / 3), (0, 2 / 3, 1, 1)), (255, 255, 255)),
+    "4-in-1": CollageLayout("standard", ((0, 0, 0.5, 0.5), (0.5, 0, 1, 0.5), (0, 0.5, 0.5, 1), (0.5, 0.5, 1, 1)),
+                            (255, 255, 255)),
+    "film-strip-3": CollageLayout("film-strip", film_frames(3), (0, 0, 0)),
+    "film-strip-4": CollageLayout("film-strip", film_frames(4), (0, 0, 0)),
+}
+
+@lru_cache(maxsize=None)
+def printable_size(outline_name: str, width: int) -> tuple:
+    """Pixel size of an outline's printable area when it is `width` pixels wide"""
+    outline = CASE_OUTLINES[outline_name]
+    with Image.open(Path(__file__).parent / outline.template) as template:
+        template_width, template_height = template.size
+    left, top, right, bottom = outline.inset
+    aspect = (template_height * (1 - top - bottom)) / (template_width * (1 - left - right))
+    return width, round(width * aspect)
+
+def slot_boxes(layout: CollageLayout, size: tuple) -> List[tuple]:
+    width, height = size
+    return [(round(l * width), round(t * height), round(r * width), round(b * height)) for l, t, r, b in layout.slots]
+
+def fit_collage_image(image_data: bytes, size: tuple, x: float, y: float, scale: float) -> np.ndarray:
+    """Decode one upload and crop/fit it into a slot (runs in the preprocessing pool)"""
+    img = Image.open(io.BytesIO(image_data))
+    # Decode no smaller than the visible region needs at this zoom
+    img.draft("RGB", (round(size[0] * scale), round(size[1] * scale)))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+    return np.asarray(place_design(img, size, x, y, scale))
+
+def assemble_collage(tiles: List[np.ndarray], boxes: List[tuple], size: tuple, background: tuple) -> Image.Image:
+    """Alpha-blend fitted slot tiles over the background in one array"""
+    canvas = np.empty((size[1], size[0], 3), dtype=np.uint8)
+    canvas[:] = background
+    for (left, top, right, bottom), tile in zip(boxes, tiles):
+        alpha = tile[..., 3:].astype(np.float32) / 255.0
+        region = canvas[top:bottom, left:right]
+        region[:] = (tile[..., :3] * alpha + region * (1.0 - alpha) + 0.5).astype(np.uint8)
+    return Image.fromarray(canvas, "RGB")
+
+def render_collage_outputs(tiles: List[np.ndarray], boxes: List[tuple], size: tuple, background: tuple,
+                           outline_name: str, preview_width: int) -> tuple:
+    """Print PNG and WebP case preview from the same canvas (runs in a worker thread)"""
+    canvas = assemble_collage(tiles, boxes, size, background)
+    buffer = io.BytesIO()
+    canvas.save(buffer, format="PNG", compress_level=3)
+    preview = encode_mockup(blend_case(canvas, outline_name, preview_width, 0.0, 0.0, 1.0), "webp")
+    return buffer.getvalue(), preview
+
+def parse_hex_color(value: str) -> tuple:
+    match = re.fullmatch(r"#?([0-9a-fA-F]{6})", value.strip())
+    if not match:
+        raise HTTPException(status_code=400, detail="background must be a #rrggbb colour")
+    return tuple(int(match.group(1)[i:i + 2], 16) for i in (0, 2, 4))
+
+@app.post("/collage")
+async def create_collage(
+    layout: str = Form(...),
+    images: List[UploadFile] = File(...),
+    transforms: Optional[str] = Form(None),
+    background: Optional[str] = Form(None),
+    preview_width: int = Form(480),
+    order_id: Optional[str] = Form(None)
+):
+    """Render a multi-image design (2/3/4-in-1, film strip) at print resolution plus a case preview.
+
+    transforms is a JSON list with one {x, y, scale} per image, using the
+    same convention as /mockup (x/y in percent of the slot). Identical
+    uploads and settings return the already rendered collage.
+    """
+    if layout not in COLLAGE_LAYOUTS:
+        raise HTTPException(status_code=404, detail=f"Unknown collage layout: {layout}")
+    collage_layout = COLLAGE_LAYOUTS[layout]
+    if len(images) != len(collage_layout.slots):
+        raise HTTPException(status_code=400,
+                            detail=f"{layout} needs {len(collage_layout.slots)} images, got {len(images)}")
+    try:
+        slot_transforms = json.loads(transforms) if transforms else [{}] * len(images)
+        slot_transforms = [(float(t.get("x", 0)), float(t.get("y", 0)), float(t.get("scale", 1)))
+                           for t in slot_transforms]
+    except (ValueError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid transforms JSON")
+    if len(slot_transforms) != len(images):
+        raise HTTPException(status_code=400, detail="transforms must have one entry per image")
+    if any(not 0.1 <= scale <= 10 for _, _, scale in slot_transforms):
+        raise HTTPException(status_code=400, detail="scale must be between 0.1 and 10")
+    fill = parse_hex_color(background) if background else collage_layout.background
+    
+    uploads = [await image.read() for image in images]
+    if any(len(data) > COLLAGE_MAX_UPLOAD_BYTES for data in uploads):
+        raise HTTPException(status_code=413, detail="Image too large")
+    size = printable_size(collage_layout.outline, COLLAGE_PRINT_WIDTH)
+    boxes = slot_boxes(collage_layout, size)
+    settings = {"layout": layout, "size": size, "transforms": slot_transforms, "background": fill}
+    
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for data in uploads:
+        digest.update(hashlib.sha256(data).digest())
+    cache_key = f"collage:{digest.hexdigest()}"
+    result = {"success": True, "template_id": layout, "style_params": {"transforms": slot_transforms,
+                                                                       "background": fill}}
+    
+    width = mockup_width(preview_width)
+    preview_url = f"/mockup/{{filename}}?layout={layout}&w={width}"
+    cache = get_result_cache()
+    cached = await cache.lookup(cache_key) if cache else None
+    if cached:
+        print(f"⚡ API - Collage cache hit: {cached['filename']}")
+        if order_id:
+            await index_generation(StoredImage(cached["filename"], cached["location"], cached.get("bytes", 0)),
+                                   result, None, f"{size[0]}x{size[1]}", None, cache_key, order_id)
+        return {**result, "filename": cached["filename"], "file_path": cached["location"],
+                "preview_url": preview_url.format(filename=cached["filename"]), "cached": True}
+    
+    started = time.perf_counter()
+    fitted = await asyncio.gather(*[
+        run_in_preprocess_pool(fit_collage_image, data, (right - left, bottom - top), x, y, scale)
+        for data, (left, top, right, bottom), (x, y, scale) in zip(uploads, boxes, slot_transforms)
+    ])
+    fit_ms = round((time.perf_counter() - started) * 1000, 1)
+    
+    print_png, preview = await asyncio.to_thread(
+        render_collage_outputs, [tile for tile, _ in fitted], boxes, size, fill, collage_layout.outline, width
+    )
+    stored = await get_image_storage().save(print_png)
+    hot_images.put(stored.filename, print_png)
+    mockup_cache.put(mockup_cache_key(stored.filename, collage_layout.outline, width, 0.0, 0.0, 1.0, "webp"), preview)
+    schedule_derivatives(stored.filename)
+    render_ms = round((time.perf_counter() - started) * 1000, 1)
+    if cache:
+        cache.put(cache_key, stored)
+    await index_generation(stored, result, None, f"{size[0]}x{size[1]}", None, cache_key, order_id, render_ms)
+    
+    print(f"🧩 API - Collage {layout} rendered in {render_ms}ms ({len(uploads)} images fitted in {fit_ms}ms)")
+    return {**result, "filename": stored.filename, "file_path": stored.location,
+            "preview_url": preview_url.format(filename=stored.filename),
+            "fit_ms": fit_ms, "render_ms": render_ms}
+
+# Print exports: artwork upscaled to the case's physical size, streamed to disk a band of rows at a time
+PRINT_DPI = int(os.getenv("PRINT_DPI", "300"))
+PRINT_BLEED_MM = float(os.getenv("PRINT_BLEED_MM", "2"))
+PRINT_SAFE_MM = float(os.getenv("PRINT_SAFE_MM", "3"))
+PRINT_BAND_ROWS = int(os.getenv("PRINT_BAND_ROWS", "256"))
+PRINT_SHARPEN = os.getenv("PRINT_SHARPEN", "true").lower() == "true"
+PRINT_EXPORT_DIR = Path(os.getenv("PRINT_EXPORT_DIR", "print-exports"))
+# Exports are re-rendered on demand, so they get their own retention, paid orders included
+PRINT_EXPORT_MAX_AGE_HOURS = float(os.getenv("PRINT_EXPORT_MAX_AGE_HOURS", "72"))
+PRINT_EXPORT_MAX_BYTES = int(os.getenv("PRINT_EXPORT_MAX_BYTES", str(5 * 1024 ** 3)))
+# zlib level for PNG/TIFF; 3 is about three times faster than 6 for ~6% more bytes on generated art
+PRINT_COMPRESS_LEVEL = int(os.getenv("PRINT_COMPRESS_LEVEL", "3"))
+# Rows rendered above and below each band so the unsharp mask has no seams
+PRINT_SHARPEN_MARGIN = 8
+
+class PrintGeometry(NamedTuple):
+    size: tuple       # full output including bleed, in pixels
+    trim_box: tuple   # (left, top, right, bottom) where the case edge falls
+    safe_box: tuple   # keep text and faces inside this
+
+def print_geometry(model: str, dpi: int) -> PrintGeometry:
+    width_mm, height_mm = PHONE_MODELS[model].print_size_mm
+    to_px = lambda mm: round(mm / 25.4 * dpi)
+    bleed, safe = to_px(PRINT_BLEED_MM), to_px(PRINT_BLEED_MM + PRINT_SAFE_MM)
+    width, height = to_px(width_mm + 2 * PRINT_BLEED_MM), to_px(height_mm + 2 * PRINT_BLEED_MM)
+    return PrintGeometry((width, height), (bleed, bleed, width - bleed, height - bleed),
+                         (safe, safe, width - safe, height - safe))
+
+def horizontal_differences(rows: np.ndarray) -> np.ndarray:
+    """Byte-wise difference from the pixel to the left (PNG "Sub" filter, TIFF predictor 2)"""
+    differences = rows.copy()
+    differences[:, 1:] -= rows[:, :-1]
+    return differences
+
+class StreamingPngWriter:
+    """RGB PNG written band by band through a single zlib stream"""
+
+    def __init__(self, f, width: int, height: int, dpi: int, description: str):
+        self.f = f
+        self.compressor = zlib.compressobj(PRINT_COMPRESS_LEVEL)
+        f.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        pixels_per_metre = round(dpi / 0.0254)
+        self._chunk(b"pHYs", struct.pack(">IIB", pixels_per_metre, pixels_per_metre, 1))
+        self._chunk(b"tEXt", b"Description\0" + description.encode("latin-1"))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self.f.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write_rows(self, rows: np.ndarray):
+        scanlines = np.empty((rows.shape[0], 1 + rows.shape[1] * 3), dtype=np.uint8)
+        scanlines[:, 0] = 1  # Sub filter
+        scanlines[:, 1:] = horizontal_differences(rows).reshape(rows.shape[0], -1)
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+
+class StreamingTiffWriter:
+    """Baseline RGB TIFF with one Deflate strip per band; the IFD goes after the strips"""
+
+    def __init__(self, f, width: int, height: int, dpi: int, description: str):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.description = description.encode("ascii") + b"\0"
+        self.rows_per_strip = None
+        self.strip_offsets: List[int] = []
+        self.strip_byte_counts: List[int] = []
+        f.write(b"II*\0\0\0\0\0")  # IFD offset patched in close()
+
+    def _align(self):
+        if self.f.tell() % 2:
+            self.f.write(b"\0")
+
+    def write_rows(self, rows: np.ndarray):
+        if self.rows_per_strip is None:
+            self.rows_per_strip = rows.shape[0]
+        data = zlib.compress(horizontal_differences(rows).tobytes(), PRINT_COMPRESS_LEVEL)
+        self._align()
+        self.strip_offsets.append(self.f.tell())
+        self.strip_byte_counts.append(len(data))
+        self.f.write(data)
+
+    def close(self):
+        self._align()
+        bits_offset = self.f.tell()
+        self.f.write(struct.pack("<3H", 8, 8, 8))
+        resolution_offset = self.f.tell()
+        self.f.write(struct.pack("<II", self.dpi, 1))
+        offsets_offset = self.f.tell()
+        self.f.write(struct.pack(f"<{len(self.strip_offsets)}I", *self.strip_offsets))
+        counts_offset = self.f.tell()
+        self.f.write(struct.pack(f"<{len(self.strip_byte_counts)}I", *self.strip_byte_counts))
+        description_offset = self.f.tell()
+        self.f.write(self.description)
+        self._align()
+        
+        strips = len(self.strip_offsets)
+        SHORT, LONG, RATIONAL, ASCII = 3, 4, 5, 2
+        entries = [
+            (256, LONG, 1, self.width), (257, LONG, 1, self.height), (258, SHORT, 3, bits_offset),
+            (259, SHORT, 1, 8),  # Deflate
+            (262, SHORT, 1, 2),  # RGB
+            (270, ASCII, len(self.description), description_offset),
+            (273, LONG, strips, offsets_offset if strips > 1 else self.strip_offsets[0]),
+            (277, SHORT, 1, 3), (278, LONG, 1, self.rows_per_strip),
+            (279, LONG, strips, counts_offset if strips > 1 else self.strip_byte_counts[0]),
+            (282, RATIONAL, 1, resolution_offset), (283, RATIONAL, 1, resolution_offset),
+            (284, SHORT, 1, 1),  # chunky
+            (296, SHORT, 1, 2),  # inches
+            (317, SHORT, 1, 2),  # horizontal differencing
+        ]
+        ifd_offset = self.f.tell()
+        self.f.write(struct.pack("<H", len(entries)))
+        for tag, kind, count, value in entries:
+            if kind == SHORT and count == 1:
+                self.f.write(struct.pack("<HHIHH", tag, kind, count, value, 0))
+            else:
+                self.f.write(struct.pack("<HHII", tag, kind, count, value))
+        self.f.write(struct.pack("<I", 0))
+        self.f.seek(4)
+        self.f.write(struct.pack("<I", ifd_offset))
+        self.f.seek(0, os.SEEK_END)
+
+def render_print_band(design: Image.Image, size: tuple, x: float, y: float, scale: float,
+                      first_row: int, last_row: int) -> np.ndarray:
+    """Upscale one band of the print onto white, sharpened using a few rows of overlap"""
+    margin = PRINT_SHARPEN_MARGIN if PRINT_SHARPEN else 0
+    top, bottom = max(0, first_row - margin), min(size[1], last_row + margin)
+    placed = place_design(design, size, x, y, scale, rows=(top, bottom), resample=Image.Resampling.LANCZOS)
+    band = Image.new("RGB", placed.size, (255, 255, 255))
+    band.paste(placed, mask=placed.getchannel("A"))
+    if PRINT_SHARPEN:
+        band = band.filter(ImageFilter.UnsharpMask(radius=1.5, percent=60, threshold=2))
+    return np.asarray(band)[first_row - top:last_row - top]
+
+def export_print(image_data: bytes, path: str, size: tuple, image_format: str, dpi: int,
+                 x: float, y: float, scale: float, description: str) -> dict:
+    """Write a print file band by band (runs in the preprocessing pool).
+
+    Only the decoded source and one band of output are in memory at a time;
+    the file appears under `path` once it is complete.
+    """
+    started = time.perf_counter()
+    design = Image.open(io.BytesIO(image_data))
+    design.load()
+    if design.mode not in ("RGB", "RGBA"):
+        design = design.convert("RGBA" if "A" in design.getbands() else "RGB")
+    decode_ms = (time.perf_counter() - started) * 1000
+    
+    resample_ms = encode_ms = 0.0
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    writer_class = StreamingTiffWriter if image_format == "tiff" else StreamingPngWriter
+    try:
+        with open(tmp_path, "wb") as f:
+            writer = writer_class(f, size[0], size[1], dpi, description)
+            for first_row in range(0, size[1], PRINT_BAND_ROWS):
+                last_row = min(size[1], first_row + PRINT_BAND_ROWS)
+                band_started = time.perf_counter()
+                band = render_print_band(design, size, x, y, scale, first_row, last_row)
+                band_rendered = time.perf_counter()
+                writer.write_rows(band)
+                resample_ms += (band_rendered - band_started) * 1000
+                encode_ms += (time.perf_counter() - band_rendered) * 1000
+            writer.close()
+            if IMAGE_FSYNC_POLICY in ("file", "dir"):
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    return {
+        "decode_ms": round(decode_ms, 1),
+        "resample_ms": round(resample_ms, 1),
+        "encode_ms": round(encode_ms, 1),
+        "total_ms": round((time.perf_counter() - started) * 1000, 1),
+        "bytes": os.path.getsize(path)
+    }
+
+def delete_print_exports(filename: str):
+    """Remove every export made from one stored image"""
+    for path in PRINT_EXPORT_DIR.glob(f"{filename.rsplit('.', 1)[0]}.*"):
+        path.unlink(missing_ok=True)
+
+def expire_print_exports() -> tuple:
+    """Delete exports unused for PRINT_EXPORT_MAX_AGE_HOURS, then the least recently used
+    until the directory fits PRINT_EXPORT_MAX_BYTES. Returns (files, bytes) removed."""
+    try:
+        with os.scandir(PRINT_EXPORT_DIR) as entries:
+            exports = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.name, Path(entry.path))
+                             for entry in entries if entry.is_file())
+    except FileNotFoundError:
+        return 0, 0
+    cutoff = time.time() - PRINT_EXPORT_MAX_AGE_HOURS * 3600
+    total = sum(size for _, size, _, _ in exports)
+    removed = freed = 0
+    for modified_at, size, name, path in exports:
+        expired = modified_at < cutoff
+        # Recent temp files belong to exports still being written
+        if not expired and (total <= PRINT_EXPORT_MAX_BYTES or name.endswith(".tmp")):
+            continue
+        try:
+            path.unlink(missing_ok=True)
+        except OSError as e:
+            print(f"⚠️ GC - Could not delete export {name}: {e}")
+            continue
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
+
+@app.post("/export/{filename}")
+async def export_print_file(
+    filename: str,
+    model: str = Form(...),
+    format: str = Form("png"),
+    dpi: int = Form(PRINT_DPI),
+    x: float = Form(0.0),
+    y: float = Form(0.0),
+    scale: float = Form(1.0)
+):
+    """Render a print-ready PNG or TIFF of a stored image for one phone model.
+
+    The artwork covers the case back plus PRINT_BLEED_MM on every side at
+    `dpi`, using the /mockup transform convention; the response gives the
+    trim and safe boxes in pixels, and timings for each stage.
+    """
+    model = model.lower()
+    if model not in PHONE_MODELS:
+        raise HTTPException(status_code=404, detail=f"Unknown phone model: {model}")
+    if format not in ("png", "tiff"):
+        raise HTTPException(status_code=400, detail="format must be png or tiff")
+    if not 72 <= dpi <= 1200:
+        raise HTTPException(status_code=400, detail="dpi must be between 72 and 1200")
+    if not 0.1 <= scale <= 10:
+        raise HTTPException(status_code=400, detail="scale must be between 0.1 and 10")
+    
+    storage = get_image_storage()
+    storage.local_path(filename)
+    geometry = print_geometry(model, dpi)
+    settings = hashlib.sha256(f"{x:g}|{y:g}|{scale:g}|{PRINT_BLEED_MM:g}|{PRINT_SHARPEN}".encode()).hexdigest()[:12]
+    name = f"{filename.rsplit('.', 1)[0]}.{model}.{dpi}dpi.{settings}.{'tif' if format == 'tiff' else 'png'}"
+    path = PRINT_EXPORT_DIR / name
+    body = {
+        "success": True,
+        "export": name,
+        "url": f"/exports/{name}",
+        "model": model,
+        "dpi": dpi,
+        "width": geometry.size[0],
+        "height": geometry.size[1],
+        "trim_box": geometry.trim_box,
+        "safe_box": geometry.safe_box
+    }
+    if await aiofiles.os.path.exists(path):
+        # Reuse counts as use for export retention
+        await asyncio.to_thread(os.utime, path)
+        return {**body, "bytes": (await aiofiles.os.stat(path)).st_size, "cached": True}
+    
+    try:
+        image_data = hot_images.get(filename) or await storage.read(filename)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Image not found")
+    get_metadata_index().note_access(filename)
     
-    return FileResponse(file_path)
+    await aiofiles.os.makedirs(PRINT_EXPORT_DIR, exist_ok=True)
+    description = json.dumps({"model": model, "trim_box": geometry.trim_box, "safe_box": geometry.safe_box})
+    stats, elapsed_ms = await run_in_preprocess_pool(
+        export_print, image_data, str(path), geometry.size, format, dpi, x, y, scale, description
+    )
+    timings = {**{k: v for k, v in stats.items() if k != "bytes"},
+               "queue_ms": round(max(0.0, elapsed_ms - stats["total_ms"]), 1)}
+    print(f"🖨️ Print export {name}: {geometry.size[0]}x{geometry.size[1]} in {elapsed_ms}ms {timings}")
+    return {**body, "bytes": stats["bytes"], "timings": timings}
+
+@app.get("/exports/{name}")
+async def get_print_export(name: str):
+    """Download a finished print export"""
+    validate_filename(name)
+    path = PRINT_EXPORT_DIR / name
+    if not await aiofiles.os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Export not found")
+    return FileResponse(path, media_type="image/tiff" if name.endswith(".tif") else "image/png", filename=name)
+
+@app.get("/history")
+async def get_history(template_id: Optional[str] = None, order_id: Optional[str] = None,
+                      before: Optional[float] = None, limit: int = 50):
+    """List recent generations, newest first (page with ?before=<created_at>)"""
+    limit = max(1, min(limit, 500))
+    items = await get_metadata_index().history(template_id, order_id, before, limit)
+    return {"items": items, "count": len(items)}
+
+@app.get("/stats")
+async def get_stats():
+    """Generation counts, storage bytes and timing per template"""
+    return await get_metadata_index().stats()
+
+@app.post("/orders/{order_id}/paid")
+async def mark_order_paid(order_id: str):
+    """Pin an order's images so the garbage collector never removes them"""
+    await get_metadata_index().mark_order_paid(order_id)
+    return {"success": True, "order_id": order_id}
 
 @app.get("/styles/{template_id}")
 async def get_template_styles(template_id: str):
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Benchmark reference image encoding profiles
+Shows conversion time (decode, resize and encode) and upload size for each profile
+in api_server.REFERENCE_ENCODING_PROFILES
+
+Usage: python bench_encoding_profiles.py [image ...]
+"""
+
+import io
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from api_server import REFERENCE_ENCODING_PROFILES, convert_image_for_api
+
+DEFAULT_IMAGES = [
+    "image gen/reference images/1533673-3840x2160-desktop-4k-ana-de-armas-wallpaper-image.jpg",
+    "image gen/reference images/margot robbie.jpg",
+    "image gen/sample images generated by chatgpt personal account/funny toon.png",
+    "image gen/sample images generated by chatgpt personal account/cover shoot.png",
+]
+
+def bench(path: Path, repeats: int = 3):
+    data = path.read_bytes()
+    with Image.open(io.BytesIO(data)) as img:
+        source = f"{img.format} {img.size[0]}x{img.size[1]}"
+    print(f"\n📷 {path.name} ({source}, {len(data) / 1024:.0f} KB)")
+    print(f"   {'profile':<15}{'convert ms':>12}{'bytes':>12}{'vs png-optimize':>18}")
+
+    baseline = None
+    for profile in REFERENCE_ENCODING_PROFILES:
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            reference = convert_image_for_api(data, profile)
+            timings.append((time.perf_counter() - started) * 1000)
+        size = len(reference.data)
+        if baseline is None:
+            baseline = size
+        print(f"   {profile:<15}{min(timings):>12.1f}{size:>12,}{size / baseline:>17.0%}")
+
+if __name__ == "__main__":
+    paths = [Path(p) for p in (sys.argv[1:] or DEFAULT_IMAGES)]
+    for path in paths:
+        if path.exists():
+            bench(path)
+        else:
+            print(f"⚠️  Skipping missing image: {path}")
@@ -1,5 +1,6 @@
 import { ArrowLeft } from 'lucide-react'
 import { useNavigate, useLocation } from 'react-router-dom'
+import aiImageService from '../services/aiImageService'
 
 const PaymentScreen = () => {
   const navigate = useNavigate()
@@ -9,6 +10,7 @@ const PaymentScreen = () => {
   const {
     designImage,
     price = 18.99,
+    orderId = null,
   } = location.state || {}
 
   // Fixed smaller blobs that match the mock-up design
@@ -51,8 +53,16 @@ const PaymentScreen = () => {
     navigate(-1)
   }
 
-  const handlePay = () => {
-    navigate('/order-confirmed', { state: { designImage, price } })
+  const handlePay = async () => {
+    // Pin the order's artwork on the server so it survives garbage collection
+    if (orderId) {
+      try {
+        await aiImageService.markOrderPaid(orderId)
+      } catch (error) {
+        console.error('Mark Order Paid Error:', error)
+      }
+    }
+    navigate('/order-confirmed', { state: { designImage, price, orderId } })
   }
 
   return (
@@ -11,9 +11,11 @@ class AIImageService {
    * @param {File|null} imageFile - Reference image file (optional)
    * @param {string} quality - Image quality ('low', 'medium', 'high')
    * @param {string} size - Image size ('1024x1024', '1024x1536', '1536x1024')
+   * @param {string|null} purpose - Routing policy ('preview', 'print', 'standard'); server default when null
+   * @param {string|null} orderId - Order to link the generation to, so it is kept once the order is paid
    * @returns {Promise<Object>} Generation result
    */
-  async generateImage(templateId, styleParams, imageFile = null, quality = 'medium', size = '1024x1024') {
+  async generateImage(templateId, styleParams, imageFile = null, quality = 'medium', size = '1024x1024', purpose = null, orderId = null) {
     try {
       console.log('🔍 Service - generateImage called')
       console.log('🔍 Service - templateId:', templateId)
@@ -26,6 +28,12 @@ class AIImageService {
       formData.append('style_params', JSON.stringify(styleParams))
       formData.append('quality', quality)
       formData.append('size', size)
+      if (purpose) {
+        formData.append('purpose', purpose)
+      }
+      if (orderId) {
+        formData.append('order_id', orderId)
+      }
       
       if (imageFile) {
         formData.append('image', imageFile)
@@ -59,13 +67,193 @@ class AIImageService {
     }
   }
 
+  /**
+   * Queue an AI generation job and wait for its result by polling /jobs/{id}
+   * Keeps each HTTP request short so flaky connections don't re-submit paid generations
+   * @param {string} templateId - Template identifier
+   * @param {Object} styleParams - Style parameters specific to the template
+   * @param {File|null} imageFile - Reference image file (optional)
+   * @param {string} quality - Image quality ('low', 'medium', 'high')
+   * @param {string} size - Image size ('1024x1024', '1024x1536', '1536x1024')
+   * @param {number} pollInterval - Milliseconds between status checks
+   * @param {string|null} orderId - Order to link the generation to
+   * @returns {Promise<Object>} Generation result (same shape as generateImage)
+   */
+  async generateImageJob(templateId, styleParams, imageFile = null, quality = 'medium', size = '1024x1024', pollInterval = 2000, orderId = null) {
+    const formData = new FormData()
+    formData.append('template_id', templateId)
+    formData.append('style_params', JSON.stringify(styleParams))
+    formData.append('quality', quality)
+    formData.append('size', size)
+    formData.append('async_job', 'true')
+    if (orderId) {
+      formData.append('order_id', orderId)
+    }
+    if (imageFile) {
+      formData.append('image', imageFile)
+    }
+
+    const response = await fetch(`${API_BASE_URL}/generate`, {
+      method: 'POST',
+      body: formData,
+    })
+    if (!response.ok) {
+      const errorData = await response.json()
+      throw new Error(errorData.detail || 'Generation failed')
+    }
+
+    const { job_id: jobId } = await response.json()
+    console.log('🔍 Service - Queued generation job:', jobId)
+
+    while (true) {
+      await new Promise(resolve => setTimeout(resolve, pollInterval))
+      let job
+      try {
+        const statusResponse = await fetch(`${API_BASE_URL}/jobs/${jobId}`)
+        if (statusResponse.status === 404) {
+          throw new Error('Generation job expired')
+        }
+        job = await statusResponse.json()
+      } catch (error) {
+        if (error.message === 'Generation job expired') throw error
+        console.warn('🔍 Service - Job poll failed, retrying:', error)
+        continue
+      }
+
+      if (job.status === 'completed') return job.result
+      if (job.status === 'failed') throw new Error(job.error || 'Generation failed')
+    }
+  }
+
+  /**
+   * Generate many images in one request; results arrive one by one as they finish
+   * @param {Object[]} items - { templateId, styleParams, imageFile, quality, size } per image
+   * @param {Function} onResult - Called with each item's result ({ index, success, filename | error })
+   * @param {string|null} orderId - Order to link every generation to
+   * @returns {Promise<Object>} Summary ({ items, succeeded, failed, elapsed_ms })
+   */
+  async generateBatch(items, onResult, orderId = null) {
+    const formData = new FormData()
+    const files = []
+    const batch = items.map(item => {
+      let image = null
+      if (item.imageFile) {
+        image = files.length
+        files.push(item.imageFile)
+      }
+      return {
+        template_id: item.templateId,
+        style_params: item.styleParams,
+        image,
+        quality: item.quality || 'medium',
+        size: item.size || '1024x1024'
+      }
+    })
+    formData.append('items', JSON.stringify(batch))
+    files.forEach(file => formData.append('images', file))
+    if (orderId) formData.append('order_id', orderId)
+
+    const response = await fetch(`${API_BASE_URL}/generate/batch`, {
+      method: 'POST',
+      body: formData,
+    })
+    if (!response.ok) {
+      const errorData = await response.json()
+      throw new Error(errorData.detail || 'Batch generation failed')
+    }
+
+    // NDJSON: one result per line, then a summary line with done: true
+    const reader = response.body.getReader()
+    const decoder = new TextDecoder()
+    let buffered = ''
+    let summary = null
+    while (true) {
+      const { value, done } = await reader.read()
+      if (done) break
+      buffered += decoder.decode(value, { stream: true })
+      const lines = buffered.split('\n')
+      buffered = lines.pop()
+      for (const line of lines) {
+        if (!line.trim()) continue
+        const message = JSON.parse(line)
+        if (message.done) summary = message
+        else onResult(message)
+      }
+    }
+    return summary
+  }
+
+  /**
+   * Mark an order as paid so the server never garbage-collects its images
+   * @param {string} orderId - Order the generations were linked to
+   * @returns {Promise<Object>} { success, order_id }
+   */
+  async markOrderPaid(orderId) {
+    const response = await fetch(`${API_BASE_URL}/orders/${encodeURIComponent(orderId)}/paid`, {
+      method: 'POST',
+    })
+    if (!response.ok) {
+      const errorData = await response.json()
+      throw new Error(errorData.detail || 'Failed to mark order paid')
+    }
+    return await response.json()
+  }
+
   /**
    * Get generated image URL
    * @param {string} filename - Generated image filename
+   * @param {number|null} width - Preview width in pixels; serves a small WebP instead of the full PNG
    * @returns {string} Image URL
    */
-  getImageUrl(filename) {
-    return `${API_BASE_URL}/image/${filename}`
+  getImageUrl(filename, width = null) {
+    return width ? `${API_BASE_URL}/image/${filename}?w=${width}` : `${API_BASE_URL}/image/${filename}`
+  }
+
+  /**
+   * Get a server-rendered phone-case mockup URL for a generated image
+   * @param {string} filename - Generated image filename
+   * @param {string} modelId - Phone model id as stored by the model screens (e.g. 'iphone-16-pro')
+   * @param {number} width - Mockup width in pixels
+   * @param {Object} transform - Preview transform { x, y, scale } (x/y in percent)
+   * @returns {string} Mockup URL
+   */
+  getMockupUrl(filename, modelId, width = 480, transform = { x: 0, y: 0, scale: 1 }) {
+    const params = new URLSearchParams({
+      model: modelId,
+      w: width,
+      x: transform.x,
+      y: transform.y,
+      scale: transform.scale
+    })
+    return `${API_BASE_URL}/mockup/${filename}?${params}`
+  }
+
+  /**
+   * Render a multi-image design server-side at print resolution
+   * @param {string} layout - Collage layout ('2-in-1', '3-in-1', '4-in-1', 'film-strip-3', 'film-strip-4')
+   * @param {File[]} imageFiles - One image per slot, top to bottom / left to right
+   * @param {Object[]} transforms - One { x, y, scale } per image (x/y in percent of the slot)
+   * @param {string|null} orderId - Order to link the collage to
+   * @returns {Promise<Object>} { filename, preview_url, ... }
+   */
+  async createCollage(layout, imageFiles, transforms = null, orderId = null) {
+    const formData = new FormData()
+    formData.append('layout', layout)
+    imageFiles.forEach(file => formData.append('images', file))
+    if (transforms) formData.append('transforms', JSON.stringify(transforms))
+    if (orderId) formData.append('order_id', orderId)
+
+    const response = await fetch(`${API_BASE_URL}/collage`, {
+      method: 'POST',
+      body: formData,
+    })
+    if (!response.ok) {
+      const errorData = await response.json()
+      throw new Error(errorData.detail || 'Collage failed')
+    }
+
+    const result = await response.json()
+    return { ...result, preview_url: `${API_BASE_URL}${result.preview_url}` }
   }
 
   /**